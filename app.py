@@ -1,489 +1,812 @@
-from flask import Flask, request, jsonify
-from pymongo import MongoClient
+from flask import Flask, Response, g, request, jsonify, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+from pymongo import MongoClient, ReturnDocument, UpdateOne
 from flask_cors import CORS
 from dotenv import load_dotenv
+import click
 import os
 from datetime import datetime
-import re
+from bson import json_util
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+# Cargar variables de entorno desde el archivo .env (antes de importar los
+# módulos que leen su configuración del entorno)
+load_dotenv()
+
+import autocomplete
+import export
+import ingest
+import metrics
+import planner
+from planner import InvalidCursor, InvalidParameter, build_facet_pipelines, encode_cursor
+import records
+from search_backends import make_search_backend
+from cache import LRUCache, TTLCache
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson es opcional
+    orjson = None
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    # jsonify con orjson cuando está instalado (mismas claves ordenadas y mismo
+    # tratamiento de fechas); con sangría (modo debug) se usa el json estándar
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs.get('indent') is not None:
+            return super().dumps(obj, **kwargs)
+        options = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        return orjson.dumps(obj, default=kwargs.get('default', self.default), option=options).decode()
+
 
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
 CORS(app, resources={r"/*": {"origins": "*"}})
 
-# Cargar variables de entorno desde el archivo .env
-load_dotenv()
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+logger = logging.getLogger(__name__)
+
+# Búsquedas más lentas que esto (ms) se registran con sus tiempos por fase
+SLOW_SEARCH_MS = float(os.getenv("SLOW_SEARCH_MS", 500))
+# Permite ?explain=true en /search; no activar en producción
+SEARCH_DEBUG = os.getenv("SEARCH_DEBUG") == "1"
 
 # Conexión a MongoDB Atlas
 mongo_uri = os.getenv("MONGO_URI")
-client = MongoClient(mongo_uri)
-db = client["archivo_digital"]
-collection = db["bilbiografia_1.0"]
+# Opciones del pool de conexiones; sin la variable se usa el valor por defecto de pymongo
+MONGO_CLIENT_OPTIONS = {
+    'maxPoolSize': 'MONGO_MAX_POOL_SIZE',
+    'minPoolSize': 'MONGO_MIN_POOL_SIZE',
+    'maxIdleTimeMS': 'MONGO_MAX_IDLE_TIME_MS',
+    'connectTimeoutMS': 'MONGO_CONNECT_TIMEOUT_MS',
+    'socketTimeoutMS': 'MONGO_SOCKET_TIMEOUT_MS',
+    'serverSelectionTimeoutMS': 'MONGO_SERVER_SELECTION_TIMEOUT_MS',
+    'waitQueueTimeoutMS': 'MONGO_WAIT_QUEUE_TIMEOUT_MS',
+}
+# Opcional: caché de vocabularios compartida entre los workers de gunicorn en una colección de Mongo
+VOCABULARY_CACHE_SHARED = os.getenv("VOCABULARY_CACHE_SHARED") == "1"
+
+client = db = collection = shared_vocabulary = cache_state = None
+client_pid = None
+
+
+def connect():
+    # Un cliente por proceso. Un MongoClient no sobrevive a un fork, y con
+    # gunicorn --preload este módulo se importa en el proceso maestro: el cliente
+    # se crea sin conectar (connect=False) y cada worker crea el suyo al arrancar
+    # (gunicorn.conf.py). Si ya hay uno de este proceso no hace nada.
+    global client, db, collection, shared_vocabulary, cache_state, client_pid
+    if client is not None and client_pid == os.getpid():
+        return
+    options = {option: int(os.environ[variable])
+               for option, variable in MONGO_CLIENT_OPTIONS.items() if os.getenv(variable)}
+    client = MongoClient(mongo_uri, connect=False, **options)
+    db = client["archivo_digital"]
+    collection = db["bilbiografia_1.0"]
+    shared_vocabulary = db["vocabulary_cache"] if VOCABULARY_CACHE_SHARED else None
+    cache_state = db["cache_state"]
+    client_pid = os.getpid()
+
+
+connect()
+
+# Motor de búsqueda de texto: Atlas Search (por defecto) o el índice local en memoria
+search_backend = make_search_backend(
+    os.getenv("SEARCH_BACKEND", "atlas"), lambda projection: collection.find({}, projection))
 
 @app.route('/')
 def home():
     return "API is running!"
 
 
-def serialize_document(doc):
-    if '_id' in doc:
-        doc['_id'] = str(doc['_id'])
-    if 'year' in doc and 'month' in doc and 'day' in doc:
-        doc['date'] = f"{doc['day']:02d}/{doc['month']:02d}/{doc['year']}"
-    elif 'year' in doc and 'month' in doc:
-        doc['date'] = f"{doc['month']:02d}/{doc['year']}"
-    elif 'day' in doc and 'month' in doc:
-        doc['date'] = f"{doc['day']:02d}/{doc['month']:02d}"
-    elif 'year' in doc:
-        doc['date'] = f"{doc['year']}"
-    else:
-        doc['date'] = None
-    if 'authors' in doc:
-        doc['authors'] = [{'name': author} for author in doc['authors']]
-    else:
-        doc['authors'] = None
-    for role in ['editor', 'translator', 'illustrator', 'coordinator', 'director']:
-        if role in doc:
-            doc[role] = [{'name': person} for person in doc[role]]
-        else:
-            doc[role] = None
-    if 'pages' in doc:
-        pass
-    else:
-        doc['pages'] = None
-    if 'city' in doc:
-        pass
-    else:
-        doc['city'] = None
-    return doc
+# Campos que se devuelven como None si el documento no los tiene
+DEFAULT_NONE_FIELDS = ('pages', 'city')
+
+
+@lru_cache(maxsize=64)
+def make_serializer(fields=None, hidden=()):
+    # Serializador para un conjunto de campos (None = documento completo): qué
+    # campos hay que convertir se decide una vez, no en cada documento. hidden
+    # son campos que solo se pidieron para calcular otros (fecha, cursor)
+    def wanted(field):
+        return fields is None or field in fields
+
+    people = tuple(field for field in records.PERSON_FIELDS if wanted(field))
+    defaults = tuple(field for field in DEFAULT_NONE_FIELDS if wanted(field))
+    with_date = wanted('date')
+
+    def serialize(doc):
+        if '_id' in doc:
+            doc['_id'] = str(doc['_id'])
+        # Los registros cargados con ingest o backfill-fields ya traen la fecha formateada
+        if with_date and 'date' not in doc:
+            doc['date'] = records.display_date(doc)
+        for field in people:
+            value = doc.get(field)
+            doc[field] = [{'name': person} for person in value] if value is not None else None
+        for field in defaults:
+            doc.setdefault(field, None)
+        for field in hidden:
+            doc.pop(field, None)
+        return doc
+
+    return serialize
+
+
+serialize_document = make_serializer()
+
+
+# Consultas independientes de una misma petición (p. ej. conteo y página) se
+# lanzan a la vez en lugar de una detrás de otra
+query_executor = ThreadPoolExecutor(max_workers=int(os.getenv("QUERY_WORKERS", 16)), thread_name_prefix='query')
+
+
+def format_facets(output, names):
+    return {
+        name: [{'value': int(bucket['_id']) if name == 'decade' else bucket['_id'], 'count': bucket['count']}
+               for bucket in output.get(name, []) if bucket['_id'] is not None]
+        for name in names
+    }
+
+
+def run_facet_pipeline(query_pipeline, facets):
+    # Recuentos en una agregación aparte, para cuando la página no usa $facet
+    return next(collection.aggregate(query_pipeline + [{'$facet': facets}]), {})
+
+
+def counts_with_facet(count_mode, has_search, has_filters):
+    # Si el total se calcula con $facet, los recuentos por valor van en la misma agregación
+    return count_mode == 'exact' or (count_mode == 'estimate' and (has_search or has_filters))
+
+
+def run_search_pipeline(query_pipeline, page_pipeline, count_mode='exact', has_filters=False, facets=None):
+    # Devuelve (total, total_es_estimado, documentos, recuentos) con una sola ida y
+    # vuelta a Atlas: el conteo, la página y los recuentos por valor (si se
+    # piden) salen de la misma agregación mediante $facet.
+    pipeline = list(query_pipeline)
+    has_search = bool(pipeline) and '$search' in pipeline[0]
+    facets = facets or {}
+
+    if count_mode == 'estimate' and not has_filters:
+        if not has_search:
+            # Sin búsqueda ni filtros basta con los metadatos de la colección
+            total = query_executor.submit(collection.estimated_document_count)
+            results = list(collection.aggregate(pipeline + page_pipeline))
+            return total.result(), True, results, None
+
+        # Atlas Search da una cota inferior del total sin recorrer todos los resultados
+        search_stage = dict(pipeline[0]['$search'])
+        search_stage['count'] = {'type': 'lowerBound'}
+        pipeline[0] = {'$search': search_stage}
+        facet = {
+            **facets,
+            'results': page_pipeline,
+            'metadata': [{'$replaceWith': '$$SEARCH_META'}, {'$limit': 1}]
+        }
+        output = next(collection.aggregate(pipeline + [{'$facet': facet}]), {})
+        metadata = output.get('metadata', [])
+        total_documents = metadata[0]['count']['lowerBound'] if metadata else 0
+        return total_documents, True, output.get('results', []), output
+
+    if count_mode == 'none':
+        return None, False, list(collection.aggregate(pipeline + page_pipeline)), None
+
+    facet = {
+        **facets,
+        'results': page_pipeline,
+        'metadata': [{'$count': 'total_documents'}]
+    }
+    output = next(collection.aggregate(pipeline + [{'$facet': facet}]), {})
+    metadata = output.get('metadata', [])
+    total_documents = metadata[0]['total_documents'] if metadata else 0
+    return total_documents, False, output.get('results', []), output
+
+# Caché de resultados de /search: muchas búsquedas se repiten (búsquedas populares,
+# usuarios que vuelven a una página anterior)
+search_cache = LRUCache(
+    max_entries=int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", 1024)),
+    max_bytes=int(os.getenv("SEARCH_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+    ttl=int(os.getenv("SEARCH_CACHE_TTL", 60)),
+)
+
+
+def search_cache_key(args):
+    # Mismos parámetros en distinto orden, o vacíos frente a ausentes, dan la misma clave
+    items = args.items(multi=True) if hasattr(args, 'getlist') else args.items()
+    return tuple(sorted((key, str(value)) for key, value in items if value not in ('', None)))
+
+
+def cached_search(args):
+    # (cuerpo JSON, estado) de una búsqueda; las peticiones idénticas
+    # simultáneas esperan a una sola agregación
+    def compute():
+        payload, status = run_search(args)
+        # Igual que jsonify, pero sin depender del contexto de la petición
+        body = app.json.response(payload).get_data()
+        metrics.lap('json_encode')
+        return body, status
+
+    return search_cache.get_or_compute(
+        search_cache_key(args), compute, cacheable=lambda value: value[1] == 200)
+
+
+def sort_label(args):
+    # Etiqueta sort de las métricas: cualquier otro valor de sortBy crearía una
+    # serie nueva por cada petición (memoria y cardinalidad sin límite)
+    sort_by = planner.text_param(args, 'sortBy', 'relevance').lower()
+    return sort_by if sort_by in planner.SORT_ORDERS else 'invalid'
+
 
 @app.route('/search', methods=['GET'])
 def search():
+    timer = metrics.start_timer()
+    body, status = cached_search(request.args)
+    response = app.response_class(body, status=status, mimetype=app.json.mimetype)
+
+    # Sin fases es que la respuesta salió de la caché
+    sort_by = sort_label(request.args)
+    for phase, seconds in timer.phases.items():
+        metrics.registry.observe('search_phase_seconds', seconds, 'Time spent in each /search phase',
+                                 phase=phase, sort=sort_by)
+    total = timer.total()
+    if total * 1000 >= SLOW_SEARCH_MS:
+        logger.warning("Slow search: %.0f ms %s phases=%s", total * 1000, dict(request.args),
+                       {phase: round(seconds * 1000, 1) for phase, seconds in timer.phases.items()})
+    if timer.phases:
+        response.headers['Server-Timing'] = ', '.join(
+            f'{phase};dur={seconds * 1000:.1f}' for phase, seconds in timer.phases.items())
+    return response
+
+
+SEARCH_BATCH_MAX_QUERIES = int(os.getenv("SEARCH_BATCH_MAX_QUERIES", 50))
+# Consultas de un lote que se ejecutan a la vez, compartiendo el pool de MongoClient
+SEARCH_BATCH_WORKERS = int(os.getenv("SEARCH_BATCH_WORKERS", 8))
+search_batch_executor = ThreadPoolExecutor(max_workers=SEARCH_BATCH_WORKERS, thread_name_prefix='search-batch')
+
+
+@app.route('/search/batch', methods=['POST'])
+def search_batch():
+    # Acepta una lista de objetos con los mismos parámetros que /search (o
+    # {"queries": [...]}) y devuelve, en el mismo orden, {"status", "body"} de cada uno
+    data = request.get_json(silent=True)
+    queries = data.get('queries') if isinstance(data, dict) else data
+    if not isinstance(queries, list):
+        return jsonify({"message": "Expected a JSON list of search parameter objects"}), 400
+    if len(queries) > SEARCH_BATCH_MAX_QUERIES:
+        return jsonify({"message": f"Too many queries (max {SEARCH_BATCH_MAX_QUERIES})"}), 400
+
+    def run(args):
+        if not isinstance(args, dict):
+            error = {"message": "Invalid parameter", "error": "Each query must be a JSON object"}
+            return app.json.dumps(error).encode(), 400
+        return cached_search({key: value for key, value in args.items() if value is not None})
+
+    responses = search_batch_executor.map(run, queries)
+    # Los cuerpos ya están codificados (y posiblemente en caché): se concatenan tal cual
+    items = (b'{"body":' + body.rstrip() + b',"status":' + str(status).encode() + b'}'
+             for body, status in responses)
+    return app.response_class(b'{"results":[' + b','.join(items) + b']}\n', mimetype=app.json.mimetype)
+
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify({"search": search_cache.stats()})
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    gauges = {f'search_cache_{name}': value for name, value in search_cache.stats().items()}
+    return Response(metrics.registry.render(gauges), mimetype='text/plain; version=0.0.4')
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_duration(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        sort_by = sort_label(request.args) if route.startswith('/search') else ''
+        metrics.registry.observe('http_request_duration_seconds', time.perf_counter() - started,
+                                 'Request latency by route and sort mode',
+                                 route=route, sort=sort_by, status=response.status_code)
+    return response
+
+
+def build_search_plan(args):
+    # Ver planner.build_search_plan; aquí se añade lo que depende de la aplicación
+    plan = planner.build_search_plan(args, search_backend)
+    plan['serializer'] = make_serializer(plan['output_fields'], plan['hidden_fields'])
+    # Solo con SEARCH_DEBUG=1: devuelve el plan de Mongo en lugar de los resultados
+    plan['explain'] = SEARCH_DEBUG and plan['explain']
+    return plan
+
+
+def run_search(args):
+    # Devuelve (respuesta, código HTTP) para los parámetros de /search
     try:
-        query = request.args.get('query', '')
-        optional_query = request.args.get('optionalQuery', '')
-        source = request.args.get('source')
-        type_ = request.args.get('type')
-        publisher = request.args.get('publisher', '')
-        start_date = request.args.get('startDate')
-        end_date = request.args.get('endDate')
-        city = request.args.get('city')
-        user_selected_fields = request.args.get('fields', "")
-        user_selected_fields2 = request.args.get('fields2', "")
-        search_type = request.args.get('searchTypeValue', '').lower()
-        sort_by = request.args.get('sortBy', 'relevance')  # Valor por defecto
-
-        page = request.args.get('page', 1)  # valor por defecto 1
-        try:
-            page = int(page)
-        except ValueError:
-            page = 1  # Si 'page' no es un número válido, establece a 1 como valor predeterminado
-        
-        limit = request.args.get('limit', 10)
-        try:
-            limit = int(limit)
-        except ValueError:
-            limit = 10  # Si 'limit' no es un número válido, establece un valor predeterminado
-
-        skip = (page - 1) * limit
-
-        print(f"Received query: {query}")
-        print(f"Received optional_query: {optional_query}")
-        print(f"Received search_type: {search_type}")
-        print(f"Received source: {source}")
-        print(f"Received type: {type_}")
-        print(f"Received publisher: {publisher}")
-        print(f"Received start_date: {start_date}")
-        print(f"Received end_date: {end_date}")
-        print(f"Received city: {city}")
-        print(f"Received fields: {user_selected_fields}")
-        print(f"Received fields2: {user_selected_fields2}")
-
-        def build_search_stage(query, optional_query=None, search_type='', user_fields=None, user_fields2=None):
-            default_fields = ["title", "source", "authors", "editor", "folder_names", "publisher", "translator", "illustrator", "coordinator", "director", "city", "book"]
-            fields = user_fields if user_fields else default_fields
-            fields2 = user_fields2 if user_fields2 else default_fields
-            if query.startswith('"') and query.endswith('"'):
-                query_type = "phrase"
-                query = query.strip('"')
-            else:
-                query_type = "text"
-
-            if optional_query and optional_query.startswith('"') and optional_query.endswith('"'):
-                optional_query_type = "phrase"
-                optional_query = optional_query.strip('"')
-            else:
-                optional_query_type = "text"
-
-            def build_compound(query, optional_query, query_type, optional_query_type, compound_type):
-                stages = [
-                    {
-                        query_type: {
-                            "query": query,
-                            "path": fields
-                        }
-                    }
-                ]
-                if query_type == "text":
-                    stages[0][query_type]["fuzzy"] = {"maxEdits": 1}
-                stages.append(
-                    {
-                        optional_query_type: {
-                            "query": optional_query,
-                            "path": fields2
-                        }
-                    }
-                )
-                if optional_query_type == "text":
-                    stages[1][optional_query_type]["fuzzy"] = {"maxEdits": 1}
-                
-                return {
-                    "$search": {
-                        "index": "default",
-                        "compound": {
-                            compound_type: stages
-                        }
-                    }
-                }
-
-            if search_type == 'and' and optional_query:
-                return build_compound(query, optional_query, query_type, optional_query_type, "must")
-            elif search_type == 'or' and optional_query:
-                return build_compound(query, optional_query, query_type, optional_query_type, "should")
-            elif search_type == 'mustnot' and optional_query:
-                stages = [
-                    {
-                        query_type: {
-                            "query": query,
-                            "path": fields
-                        }
-                    }
-                ]
-                if query_type == "text":
-                    stages[0][query_type]["fuzzy"] = {"maxEdits": 1}
-                stages.append(
-                    {
-                        optional_query_type: {
-                            "query": optional_query,
-                            "path": fields2
-                        }
-                    }
-                )
-                if optional_query_type == "text":
-                    stages[1][optional_query_type]["fuzzy"] = {"maxEdits": 1}
-                
-                return {
-                    "$search": {
-                        "index": "default",
-                        "compound": {
-                            "must": [stages[0]],
-                            "mustNot": [stages[1]]
-                        }
-                    }
-                }
-            else:
-                search_stage = {
-                    "$search": {
-                        "index": "default",
-                        query_type: {
-                            "query": query,
-                            "path": fields
-                        }
-                    }
-                }
-                if query_type == "text":
-                    search_stage["$search"][query_type]["fuzzy"] = {"maxEdits": 1}
-                return search_stage
-
-        query_pipeline = []
-
-        if query or optional_query:
-            search_stage = build_search_stage(query, optional_query, search_type, user_selected_fields, user_selected_fields2)
-            query_pipeline.append(search_stage)
-
-        match_filter = {}
-        if source:
-            match_filter["source"] = source
-        if type_:
-            match_filter["type"] = type_
-        if publisher:
-            match_filter['publisher'] = publisher
-        if city:
-            match_filter['city'] = city
-
-        if start_date or end_date:
-            if start_date and re.match(r'^\d{4}$', start_date):
-                start_date = f'01/01/{start_date}'
-            if end_date and re.match(r'^\d{4}$', end_date):
-                end_date = f'31/12/{end_date}'
-
-            start_datetime = datetime.strptime(start_date, '%d/%m/%Y') if start_date else None
-            end_datetime = datetime.strptime(end_date, '%d/%m/%Y') if end_date else None
-
-            date_filter = {"$and": []}
-
-            if start_datetime:
-                date_filter["$and"].append({
-                    "$expr": {
-                        "$gte": [
-                            {"$dateFromParts": {
-                                "year": "$year",
-                                "month": {"$ifNull": ["$month", 1]},
-                                "day": {"$ifNull": ["$day", 1]}
-                            }},
-                            {"$literal": start_datetime}
-                        ]
-                    }
-                })
-
-            if end_datetime:
-                date_filter["$and"].append({
-                    "$expr": {
-                        "$lte": [
-                            {"$dateFromParts": {
-                                "year": "$year",
-                                "month": {"$ifNull": ["$month", 12]},
-                                "day": {"$ifNull": ["$day", 31]}
-                            }},
-                            {"$literal": end_datetime}
-                        ]
-                    }
-                })
-
-            if date_filter["$and"]:
-                query_pipeline.append({"$match": date_filter})
-
-        if match_filter:
-            query_pipeline.append({"$match": match_filter})
-
-        # Filtro para excluir documentos cuya fecha/publisher sea "N/D"
-        if start_date or end_date:
-            query_pipeline.append({"$match": {"year": {"$ne": None}}})
-        if publisher:
-            query_pipeline.append({"$match": {"publisher": {"$ne": None}}})
-
-        # Añadir campos normalizados para ordenación
-        query_pipeline.append({
-    "$addFields": {
-        "normalized_date": {
-            "$cond": {
-                "if": { "$and": [
-                    { "$ne": ["$year", None] },
-                    { "$ne": ["$month", None] },
-                    { "$ne": ["$day", None] }
-                ]},
-                "then": {
-                    "$dateFromParts": {
-                        "year": "$year",
-                        "month": {"$ifNull": ["$month", 1]},
-                        "day": {"$ifNull": ["$day", 1]}
-                    }
-                },
-                "else": None  # Asignar None si no hay fecha completa
-            }
-        }
-    }
-})
-        
-
-       # Agregar etapa para contar el total de documentos que coinciden con el filtro
-        count_pipeline = query_pipeline.copy()
-        count_pipeline.append({'$count': 'total_documents'})
-
-        # Ejecutar el pipeline para obtener el total de documentos
-        total_documents_result = list(collection.aggregate(count_pipeline))
-        total_documents = total_documents_result[0]['total_documents'] if total_documents_result else 0
-        
-        print(match_filter)
-        print(query_pipeline)
-
-        # Ordenar usando el nuevo campo sort_date
-        def get_sort_order(sort_by):
-            if sort_by == 'date':
-                query_pipeline.append({
-                    "$addFields": {
-                        "sort_date": {
-                            "$ifNull": ["$normalized_date", {
-                                "$dateFromParts": {
-                                    "year": 1111,
-                                    "month": 12,
-                                    "day": 31
-                                }
-                            }]
-                        }
-                    }
-                })
-                return [
-                    ('sort_date', -1),  # Ordenar por fecha descendente
-                    ('_id', 1)  # Desempate para mantener un orden estable
-                ]
-            elif sort_by == 'date-asc':
-                query_pipeline.append({
-                    "$addFields": {
-                        "sort_date": {
-                            "$ifNull": ["$normalized_date", {
-                                "$dateFromParts": {
-                                    "year": 9999,
-                                    "month": 12,
-                                    "day": 31
-                                }
-                            }]
-                        }
-                    }
-                })
-                return [
-                    ('sort_date', 1),  # Ordenar por fecha ascendente, los null se van al final
-                    ('_id', 1)  # Desempate para mantener un orden estable
-                ]
-            elif sort_by in ['title', 'title-desc']:
-                # Normalizar letras mayúsculas con tildes cerradas y abiertas en el campo `normalized_title`
-                query_pipeline.append({
-                    "$addFields": {
-                        "normalized_title": {
-                            "$replaceAll": {
-                                "input": {
-                                    "$replaceAll": {
-                                        "input": {
-                                            "$replaceAll": {
-                                                "input": {
-                                                    "$replaceAll": {
-                                                        "input": {
-                                                            "$replaceAll": {
-                                                                "input": {
-                                                                    "$replaceAll": {
-                                                                        "input": {
-                                                                            "$replaceAll": {
-                                                                                "input": {
-                                                                                    "$replaceAll": {
-                                                                                        "input": {
-                                                                                            "$replaceAll": {
-                                                                                                "input": {
-                                                                                                    "$replaceAll": {
-                                                                                                        "input": {
-                                                                                                            "$replaceAll": {
-                                                                                                                "input": "$title",
-                                                                                                                "find": "Á",
-                                                                                                                "replacement": "A"
-                                                                                                            }
-                                                                                                        },
-                                                                                                        "find": "À",
-                                                                                                        "replacement": "A"
-                                                                                                    }
-                                                                                                },
-                                                                                                "find": "É",
-                                                                                                "replacement": "E"
-                                                                                            }
-                                                                                        },
-                                                                                        "find": "È",
-                                                                                        "replacement": "E"
-                                                                                    }
-                                                                                },
-                                                                                "find": "Í",
-                                                                                "replacement": "I"
-                                                                            }
-                                                                        },
-                                                                        "find": "Ì",
-                                                                        "replacement": "I"
-                                                                    }
-                                                                },
-                                                                "find": "Ó",
-                                                                "replacement": "O"
-                                                            }
-                                                        },
-                                                        "find": "Ò",
-                                                        "replacement": "O"
-                                                    }
-                                                },
-                                                "find": "Ú",
-                                                "replacement": "U"
-                                            }
-                                        },
-                                        "find": "Ù",
-                                        "replacement": "U"
-                                    }
-                                },
-                                "find": "Ñ",
-                                "replacement": "N"
-                            }
-                        }
-                    }
-                })
-
-                # Usar regex para encontrar el primer carácter alfabético y hacer la ordenación a partir de él
-                query_pipeline.append({
-                    "$addFields": {
-                        "normalized_title": {
-                            "$cond": {
-                                "if": {"$regexMatch": {"input": "$normalized_title", "regex": r"[a-zA-Z].*"}},
-                                "then": {
-                                    "$regexFind": {
-                                        "input": "$normalized_title",
-                                        "regex": r"[a-zA-Z].*"
-                                    }
-                                },
-                                "else": "$normalized_title"
-                            }
-                        }
-                    }
-                })
-
-                return [
-                    ('normalized_title.match', 1 if sort_by == 'title' else -1)
-                ]
-            else:
-                return [('relevance', 1)]  # Valor por defecto
-        # Obtener la ordenación
-        sort_order = get_sort_order(sort_by)
-        query_pipeline.append({'$sort': dict(sort_order)})
+        plan = build_search_plan(args)
+        query_pipeline = plan['query_pipeline'] + plan['cursor_stages']
+        sort_by, cursor = plan['sort_by'], plan['cursor']
+        limit, skip, count_mode = plan['limit'], plan['skip'], plan['count_mode']
+
+        if plan['ranked'] is not None:
+            return run_ranked_search(plan)
+
+        # Sin $search la ordenación va antes del $facet para que Mongo recorra
+        # los índices (sort_title, _id) / (sort_undated, sort_date, _id) en vez de
+        # ordenar en memoria; con $search solo se ordena lo que devuelve Atlas
+        page_pipeline = []
+        if plan['has_search']:
+            page_pipeline.extend(plan['sort_stages'])
+        else:
+            query_pipeline = query_pipeline + plan['sort_stages']
 
         # Etapas de paginación
-        query_pipeline.append({'$skip': skip})
-        query_pipeline.append({'$limit': limit})
+        if not cursor:
+            page_pipeline.append({'$skip': skip})
+        # Sin conteo exacto se pide un documento de más para saber si hay página
+        # siguiente: una estimación (lowerBound) puede quedarse corta
+        page_pipeline.append({'$limit': limit if count_mode == 'exact' else limit + 1})
+        # Solo viajan los campos pedidos, y solo para los documentos de la página
+        page_pipeline.append({'$project': plan['projection']})
+
+        if plan['explain']:
+            return explain_search(query_pipeline, page_pipeline, count_mode), 200
+
+        facets = build_facet_pipelines(plan['facets'])
+        separate_facets = None
+        if facets and not counts_with_facet(count_mode, plan['has_search'], plan['has_post_filters']):
+            # Sin $facet para el total (o con cursor) se calculan a la vez, en
+            # otra agregación, sobre la búsqueda sin paginar
+            separate_facets = query_executor.submit(run_facet_pipeline, plan['query_pipeline'], facets)
+            facets = None
+
+        total_documents, total_is_estimate, results, facet_output = run_search_pipeline(
+            query_pipeline, page_pipeline, count_mode, has_filters=plan['has_post_filters'], facets=facets)
+        if separate_facets is not None:
+            facet_output = separate_facets.result()
+        metrics.lap('aggregation')
+
+        if count_mode == 'exact':
+            has_more = skip + len(results) < total_documents
+        else:
+            has_more = len(results) > limit
+            results = results[:limit]
+            if total_is_estimate and not cursor:
+                # El total estimado nunca por debajo de lo que ya se ha visto
+                total_documents = max(total_documents, skip + len(results) + has_more)
 
-       # Aplicar paginación y limitar resultados
-        results = list(collection.aggregate(query_pipeline))
+        next_cursor = encode_cursor(plan['cursor_fields'], sort_by, results[-1]) if has_more and results else None
 
-        serialized_results = [serialize_document(doc) for doc in results]
+        return build_search_response(plan, total_documents, total_is_estimate, results, has_more, next_cursor,
+                                     facet_output), 200
 
-        response = {
-            "total_documents": total_documents,
-            "total_pages": (total_documents + limit - 1) // limit,  # Redondear hacia arriba
-            "current_page": page,
-            "results": serialized_results
-        }
+    except InvalidCursor as e:
+        return {"message": "Invalid cursor", "error": str(e)}, 400
+    except InvalidParameter as e:
+        return {"message": "Invalid parameter", "error": str(e)}, 400
+    except Exception as e:
+        logger.exception("Error during search")
+        return {"message": "Error during search", "error": str(e)}, 500
 
-        return jsonify(response)
 
+def explain_search(query_pipeline, page_pipeline, count_mode):
+    if count_mode == 'none':
+        pipeline = query_pipeline + page_pipeline
+    else:
+        pipeline = query_pipeline + [{'$facet': {
+            'results': page_pipeline,
+            'metadata': [{'$count': 'total_documents'}]
+        }}]
+    explain = db.command('explain', {'aggregate': collection.name, 'pipeline': pipeline, 'cursor': {}},
+                         verbosity='queryPlanner')
+    # Los tipos BSON (ObjectId, fechas...) se pasan a JSON extendido
+    return json.loads(json_util.dumps({'pipeline': pipeline, 'explain': explain}))
+
+
+def fetch_ranked(ranked, projection):
+    # Documentos de una lista [(_id, puntuación)] en el mismo orden
+    ids = [doc_id for doc_id, _ in ranked]
+    docs = {doc['_id']: doc for doc in collection.find({'_id': {'$in': ids}}, projection)}
+    results = []
+    for doc_id, score in ranked:
+        if doc_id in docs:
+            results.append(docs[doc_id])
+            results[-1]['score'] = score
+    return results
+
+
+def run_ranked_search(plan):
+    # Relevancia con el índice local: el total y el orden ya se conocen, así que
+    # a Mongo solo se le piden los documentos de la página
+    ranked, offset, limit = plan['ranked'], plan['offset'], plan['limit']
+    facets = build_facet_pipelines(plan['facets'])
+    facet_output = query_executor.submit(run_facet_pipeline, plan['query_pipeline'], facets) if facets else None
+    results = fetch_ranked(ranked[offset:offset + limit], plan['projection'])
+    if facet_output is not None:
+        facet_output = facet_output.result()
+    metrics.lap('aggregation')
+    if not plan['include_score']:
+        for doc in results:
+            doc.pop('score', None)
+    has_more = offset + limit < len(ranked)
+    next_cursor = encode_cursor(['offset'], plan['sort_by'], {'offset': offset + limit}) if has_more else None
+    return build_search_response(plan, len(ranked), False, results, has_more, next_cursor, facet_output), 200
+
+
+def build_search_response(plan, total_documents, total_is_estimate, results, has_more, next_cursor,
+                          facet_output=None):
+    limit, count_mode, cursor = plan['limit'], plan['count_mode'], plan['cursor']
+    serialize = plan['serializer']
+    serialized_results = [serialize(doc) for doc in results]
+    metrics.lap('serialize')
+
+    response = {
+        "total_documents": total_documents,
+        "total_pages": (total_documents + limit - 1) // limit if total_documents is not None else None,  # Redondear hacia arriba
+        "current_page": plan['page'] if not cursor else None,
+        "next_cursor": next_cursor,
+        "results": serialized_results
+    }
+    if count_mode != 'exact':
+        response["total_is_estimate"] = total_is_estimate
+    if count_mode == 'none':
+        response["has_more"] = has_more
+    if plan['facets']:
+        response["facets"] = format_facets(facet_output or {}, plan['facets'])
+    return response
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 500))
+EXPORT_IGNORED_PARAMS = ('cursor', 'page', 'limit')
+
+@app.route('/search/export', methods=['GET'])
+def export_search():
+    # Todos los resultados de una búsqueda en un único cursor, enviados por trozos:
+    # la memoria usada no depende del número de resultados. Se exporta siempre la
+    # búsqueda entera: page, limit y cursor no se tienen en cuenta
+    export_format = request.args.get('format', 'ndjson').lower()
+    if export_format not in export.FORMATS:
+        return jsonify({"message": "Unsupported export format", "error": export_format}), 400
+    mimetype, extension, header, render = export.FORMATS[export_format]
+
+    # Sin los parámetros de paginación el plan empieza por el primer resultado
+    # (ni $skip, ni keyset $match, ni searchAfter de Atlas)
+    args = {name: value for name, value in request.args.items() if name not in EXPORT_IGNORED_PARAMS}
+    try:
+        plan = build_search_plan(args)
+    except InvalidParameter as e:
+        return jsonify({"message": "Invalid parameter", "error": str(e)}), 400
     except Exception as e:
-        print(f"Exception: {e}")
-        return jsonify({"message": "Error during search", "error": str(e)}), 500
+        return jsonify({"message": "Error during export", "error": str(e)}), 500
+    pipeline = plan['query_pipeline'] + plan['sort_stages'] + [{'$project': plan['projection']}]
+    ranked = plan['ranked']
+    serialize = plan['serializer']
+
+    def prepare(doc):
+        doc.pop('score', None)
+        return serialize(doc)
+
+    def generate():
+        if header:
+            yield header()
+        if ranked is not None:
+            # Índice local por relevancia: los documentos se piden por lotes en su orden
+            for start in range(0, len(ranked), EXPORT_BATCH_SIZE):
+                batch = fetch_ranked(ranked[start:start + EXPORT_BATCH_SIZE], plan['projection'])
+                yield render([prepare(doc) for doc in batch])
+            return
+        cursor = collection.aggregate(pipeline, batchSize=EXPORT_BATCH_SIZE)
+        try:
+            batch = []
+            for doc in cursor:
+                batch.append(prepare(doc))
+                if len(batch) == EXPORT_BATCH_SIZE:
+                    yield render(batch)
+                    batch = []
+            if batch:
+                yield render(batch)
+        finally:
+            cursor.close()
+
+    response = Response(stream_with_context(generate()), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename=search.{extension}'
+    return response
+
+# Vocabularios (listas de valores para los filtros): cambian muy poco y el
+# frontend los pide en cada carga de página, así que se guardan en caché
+VOCABULARY_FIELDS = {
+    'sources': 'source',
+    'types': 'type',
+    'publishers': 'publisher',
+    'cities': 'city',
+}
+vocabulary_cache = TTLCache(int(os.getenv("VOCABULARY_CACHE_TTL", 300)))
+
+
+def get_vocabulary(name, compute):
+    # Devuelve {'value': ..., 'computed_at': datetime}; computed_at sirve para Last-Modified
+    entry = vocabulary_cache.get(name)
+    if entry is not None:
+        return entry
+    if shared_vocabulary is not None:
+        shared = shared_vocabulary.find_one({'_id': name})
+        if shared and (datetime.utcnow() - shared['computed_at']).total_seconds() < vocabulary_cache.ttl:
+            entry = {'value': shared['value'], 'computed_at': shared['computed_at']}
+    if entry is None:
+        # Mongo guarda las fechas con precisión de milisegundos; Last-Modified, de segundos
+        entry = {'value': compute(), 'computed_at': datetime.utcnow().replace(microsecond=0)}
+        if shared_vocabulary is not None:
+            shared_vocabulary.replace_one({'_id': name}, dict(entry, _id=name), upsert=True)
+    vocabulary_cache.set(name, entry)
+    return entry
+
+
+# Generación de las cachés, guardada en Mongo para que la invalidación llegue a
+# todos los procesos: invalidate_vocabulary() la incrementa y cada worker la
+# consulta cada CACHE_GENERATION_CHECK segundos (ver watch_cache_generation)
+CACHE_GENERATION_CHECK = float(os.getenv("CACHE_GENERATION_CHECK", 5))
+cache_generation = None
+
+
+def clear_local_caches():
+    vocabulary_cache.invalidate()
+    search_cache.invalidate()
+    autocomplete_cache.invalidate()
+    search_backend.invalidate()
+
+
+def read_cache_generation():
+    state = cache_state.find_one({'_id': 'generation'})
+    return state['value'] if state else 0
+
+
+def invalidate_vocabulary():
+    # Llamar después de modificar registros para no servir vocabularios ni resultados
+    # antiguos, en este proceso y en los workers del servidor
+    global cache_generation
+    clear_local_caches()
+    if shared_vocabulary is not None:
+        shared_vocabulary.delete_many({})
+    state = cache_state.find_one_and_update(
+        {'_id': 'generation'}, {'$inc': {'value': 1}}, upsert=True, return_document=ReturnDocument.AFTER)
+    cache_generation = state['value']
+
+
+def watch_cache_generation():
+    # Vacía las cachés locales cuando otro proceso (p. ej. `flask ingest`) ha invalidado
+    global cache_generation
+    while True:
+        try:
+            generation = read_cache_generation()
+            if cache_generation is not None and generation != cache_generation:
+                logger.info("Cache generation changed to %s, clearing local caches", generation)
+                clear_local_caches()
+            cache_generation = generation
+        except Exception:
+            logger.warning("Could not read the cache generation", exc_info=True)
+        time.sleep(CACHE_GENERATION_CHECK)
+
+
+def compute_facets():
+    # Los cuatro vocabularios con su número de documentos en una sola agregación.
+    # Como $sortByCount, pero con desempate por valor: el cuerpo (y su ETag) no
+    # cambia al recalcularlo si no cambian los datos
+    facet = {
+        name: [
+            {'$unwind': f'${field}'},
+            {'$group': {'_id': f'${field}', 'count': {'$sum': 1}}},
+            {'$sort': {'count': -1, '_id': 1}},
+        ]
+        for name, field in VOCABULARY_FIELDS.items()
+    }
+    output = next(collection.aggregate([{'$facet': facet}]), {})
+    return {
+        name: [{'value': bucket['_id'], 'count': bucket['count']} for bucket in output.get(name, [])]
+        for name in VOCABULARY_FIELDS
+    }
+
+
+def vocabulary_response(entry):
+    # ETag/Last-Modified para que el navegador reciba 304 si nada ha cambiado
+    response = jsonify(entry['value'])
+    response.add_etag()
+    response.last_modified = entry['computed_at']
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 @app.route('/get_sources', methods=['GET'])
 def get_sources():
     try:
-        sources = collection.distinct("source")
-        return jsonify(sources)
+        sources = get_vocabulary('sources', lambda: collection.distinct("source"))
+        return vocabulary_response(sources)
     except Exception as e:
         return jsonify({"message": "Error retrieving sources", "error": str(e)}), 500
 
 @app.route('/get_types', methods=['GET'])
 def get_types():
     try:
-        types = collection.distinct("type")
-        return jsonify(types)
+        types = get_vocabulary('types', lambda: collection.distinct("type"))
+        return vocabulary_response(types)
     except Exception as e:
         return jsonify({"message": "Error retrieving types", "error": str(e)}), 500
 
 @app.route('/get_publishers', methods=['GET'])
 def get_publishers():
-    publishers = collection.distinct("publisher")
-    return jsonify(publishers)
+    publishers = get_vocabulary('publishers', lambda: collection.distinct("publisher"))
+    return vocabulary_response(publishers)
 
 @app.route('/get_city', methods=['GET'])
 def get_city():
     try:
-        city = collection.distinct("city")
-        return jsonify(city)
+        city = get_vocabulary('cities', lambda: collection.distinct("city"))
+        return vocabulary_response(city)
     except Exception as e:
         return jsonify({"message": "Error retrieving cities", "error": str(e)}), 500
 
+@app.route('/facets', methods=['GET'])
+def facets():
+    try:
+        return vocabulary_response(get_vocabulary('facets', compute_facets))
+    except Exception as e:
+        return jsonify({"message": "Error retrieving facets", "error": str(e)}), 500
+
+# Índices de autocompletado (uno por campo), reconstruidos cuando caducan
+autocomplete_cache = TTLCache(int(os.getenv("AUTOCOMPLETE_TTL", 600)))
+autocomplete_lock = threading.Lock()
+
+
+def get_prefix_index(field):
+    prefix_index = autocomplete_cache.get(field)
+    if prefix_index is None:
+        with autocomplete_lock:
+            # Solo un hilo reconstruye; el resto usa el índice recién construido
+            prefix_index = autocomplete_cache.get(field)
+            if prefix_index is None:
+                prefix_index = autocomplete.build_prefix_index(collection, field)
+                autocomplete_cache.set(field, prefix_index)
+    return prefix_index
+
+@app.route('/autocomplete', methods=['GET'])
+def autocomplete_values():
+    field = request.args.get('field', 'title')
+    prefix = request.args.get('prefix', '')
+    if field not in autocomplete.FIELDS:
+        return jsonify({"message": "Unsupported autocomplete field", "error": field}), 400
+    try:
+        limit = planner.int_param(request.args, 'limit', 10, 1, autocomplete.MAX_RESULTS)
+    except InvalidParameter as e:
+        return jsonify({"message": "Invalid parameter", "error": str(e)}), 400
+    try:
+        return jsonify(get_prefix_index(autocomplete.FIELDS[field]).complete(prefix, limit))
+    except Exception as e:
+        return jsonify({"message": "Error retrieving completions", "error": str(e)}), 500
+
+@app.cli.command('invalidate-vocabulary')
+def invalidate_vocabulary_command():
+    invalidate_vocabulary()
+    print("Vocabulary cache invalidated")
+
+def ensure_indexes():
+    # Índices que permiten ordenar y filtrar recorriendo el índice en lugar de hacerlo en memoria
+    collection.create_index([('sort_title', 1), ('_id', 1)])
+    collection.create_index([('sort_undated', 1), ('sort_date', 1), ('_id', 1)])
+    collection.create_index([('sort_undated', 1), ('sort_date', -1), ('_id', -1)])
+    # Filtro por rango de fechas (startDate / endDate)
+    collection.create_index([('date_lo', 1)])
+    collection.create_index([('date_hi', 1)])
+    # Deduplicación de la carga masiva (flask ingest)
+    collection.create_index([('content_hash', 1)])
+
+@app.cli.command('backfill-fields')
+def backfill_fields():
+    # Recalcula los campos derivados (records.derived_fields) de todos los registros
+    # existentes, y su content_hash para que flask ingest no los vuelva a cargar
+    projection = {field: 0 for field in planner.INTERNAL_FIELDS}
+    operations = []
+    updated = 0
+    for doc in collection.find({}, projection):
+        fields = records.derived_fields(doc)
+        try:
+            fields['content_hash'] = ingest.content_hash(ingest.normalize(doc))
+        except ingest.InvalidRecord:
+            pass
+        operations.append(UpdateOne({'_id': doc['_id']}, {'$set': fields}))
+        if len(operations) == 1000:
+            updated += collection.bulk_write(operations, ordered=False).modified_count
+            operations = []
+    if operations:
+        updated += collection.bulk_write(operations, ordered=False).modified_count
+    ensure_indexes()
+    invalidate_vocabulary()
+    print(f"Updated {updated} documents")
+
+@app.cli.command('ingest')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(sorted(ingest.READERS)),
+              help='Formato de los ficheros (por defecto, según la extensión)')
+@click.option('--batch-size', default=ingest.BATCH_SIZE, show_default=True)
+def ingest_command(paths, file_format, batch_size):
+    # Carga masiva: flask ingest registros.bib otros.csv
+    ensure_indexes()
+    for path in paths:
+        started = time.perf_counter()
+        stats = ingest.ingest_file(collection, path, file_format, batch_size)
+        for error in stats.pop('errors'):
+            print(f"  {error}")
+        print(f"{path}: {stats} in {time.perf_counter() - started:.1f}s")
+    # Los vocabularios y búsquedas en caché ya no reflejan la colección
+    invalidate_vocabulary()
+
+# Arranque en caliente: antes de declararse listo en /healthz cada proceso abre
+# conexiones y llena las cachés de vocabularios, autocompletado, el índice local y
+# la primera página de /search, para que los primeros usuarios no paguen el arranque
+ready = threading.Event()
+warm_up_lock = threading.Lock()
+warm_up_started = False
+
+
+def warm_up():
+    started = time.perf_counter()
+    client.admin.command('ping')
+    for name, field in VOCABULARY_FIELDS.items():
+        get_vocabulary(name, lambda field=field: collection.distinct(field))
+    get_vocabulary('facets', compute_facets)
+    for field in autocomplete.FIELDS:
+        get_prefix_index(field)
+    if search_backend.name == 'local':
+        search_backend.index
+    # Una búsqueda que falla (p. ej. un 500 de Atlas) no cuenta como lista: se reintenta
+    body, status = cached_search({})
+    if status != 200:
+        raise RuntimeError(f"Warm-up search returned {status}: {body[:200]!r}")
+    ready.set()
+    logger.info("Warm-up finished in %.1f s", time.perf_counter() - started)
+
+
+def start_warm_up():
+    # En segundo plano, reintentando si MongoDB todavía no responde; solo una vez por
+    # proceso. También empieza a vigilar la generación de las cachés
+    global warm_up_started
+    with warm_up_lock:
+        if warm_up_started:
+            return
+        warm_up_started = True
+
+    def run():
+        delay = 1
+        while not ready.is_set():
+            try:
+                warm_up()
+            except Exception:
+                logger.exception("Warm-up failed, retrying in %d s", delay)
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    threading.Thread(target=run, name='warm-up', daemon=True).start()
+    threading.Thread(target=watch_cache_generation, name='cache-generation', daemon=True).start()
+
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    # Listo (200) solo cuando el arranque en caliente ha terminado y MongoDB responde
+    start_warm_up()
+    if not ready.is_set():
+        return jsonify({"status": "warming"}), 503
+    try:
+        client.admin.command('ping')
+    except Exception as e:
+        return jsonify({"status": "unavailable", "error": str(e)}), 503
+    return jsonify({"status": "ok"})
+
 if __name__ == '__main__':
+    start_warm_up()
     app.run(debug=True)
@@ -0,0 +1,80 @@
+from bisect import bisect_left
+from collections import defaultdict
+import heapq
+
+from records import fold_text, sort_title
+
+# Autocompletado en memoria para /autocomplete: valores ordenados por su forma
+# normalizada (sin tildes ni mayúsculas, como la ordenación por título), de
+# forma que un prefijo corresponde a un tramo contiguo que se encuentra con bisect.
+
+FIELDS = {
+    'title': 'title',
+    'authors': 'authors',
+    'publisher': 'publisher',
+}
+
+# Los prefijos muy cortos abarcan casi toda la lista: su top-k se calcula al construir
+PRECOMPUTED_PREFIX_LENGTH = 2
+MAX_RESULTS = 50
+
+
+def fold_key(field, value):
+    return sort_title(value) if field == 'title' else fold_text(value)
+
+
+class PrefixIndex:
+
+    def __init__(self, field, counts):
+        # counts: {valor original: número de documentos}
+        self.field = field
+        grouped = defaultdict(lambda: [0, None, 0])
+        for value, count in counts.items():
+            key = fold_key(field, value)
+            if not key:
+                continue
+            entry = grouped[key]
+            entry[0] += count
+            # Se muestra la variante más frecuente de las que comparten forma normalizada
+            if count > entry[2]:
+                entry[1], entry[2] = value, count
+        self._keys = sorted(grouped)
+        self._entries = [(grouped[key][1], grouped[key][0]) for key in self._keys]
+
+        top = defaultdict(list)
+        for key, entry in zip(self._keys, self._entries):
+            for length in range(PRECOMPUTED_PREFIX_LENGTH + 1):
+                if length <= len(key):
+                    top[key[:length]].append(entry)
+        self._top = {
+            prefix: heapq.nlargest(MAX_RESULTS, entries, key=lambda entry: entry[1])
+            for prefix, entries in top.items()
+        }
+
+    def __len__(self):
+        return len(self._keys)
+
+    def complete(self, prefix, limit=10):
+        key = fold_key(self.field, prefix) if prefix.strip() else ''
+        limit = min(limit, MAX_RESULTS)
+        if len(key) <= PRECOMPUTED_PREFIX_LENGTH:
+            matches = self._top.get(key, [])[:limit]
+        else:
+            start = bisect_left(self._keys, key)
+            end = bisect_left(self._keys, key + '\U0010ffff', start)
+            matches = heapq.nlargest(limit, self._entries[start:end], key=lambda entry: entry[1])
+        return [{'value': value, 'count': count} for value, count in matches]
+
+
+def build_prefix_index(collection, field):
+    # Frecuencia de cada valor (los arrays como authors se cuentan por elemento)
+    pipeline = [
+        {'$project': {field: 1}},
+        {'$unwind': f'${field}'},
+        {'$group': {'_id': f'${field}', 'count': {'$sum': 1}}},
+    ]
+    counts = defaultdict(int)
+    for bucket in collection.aggregate(pipeline):
+        if bucket['_id'] is not None:
+            counts[str(bucket['_id'])] += bucket['count']
+    return PrefixIndex(field, counts)
@@ -0,0 +1,87 @@
+import random
+
+import records
+
+# Corpus bibliográfico sintético y reproducible (misma semilla, mismos registros)
+# con títulos, personas, editoriales y fechas parciales parecidos a los reales.
+
+TITLE_WORDS = [
+    'història', 'historia', 'llibre', 'libro', 'cartes', 'cartas', 'poesia', 'poesía', 'teatre', 'teatro',
+    'memòries', 'memorias', 'crònica', 'crónica', 'viatge', 'viaje', 'ciutat', 'ciudad', 'mar', 'muntanya',
+    'montaña', 'guerra', 'pau', 'paz', 'música', 'art', 'arte', 'dona', 'mujer', 'infància', 'infancia',
+    'literatura', 'catalana', 'española', 'valenciana', 'mallorquina', 'obra', 'completa', 'antologia',
+    'antología', 'diari', 'diario', 'estudis', 'estudios', 'segle', 'siglo', 'xix', 'xx', 'revista',
+    'traducció', 'traducción', 'contes', 'cuentos', 'novel·la', 'novela', 'assaig', 'ensayo', 'Ñandú',
+]
+LINK_WORDS = ['de', 'del', 'de la', 'i', 'y', 'a', 'en', 'sobre', 'per a', 'para']
+TITLE_PREFIXES = ['', '', '', '', '"', '«', '¿', '1. ', 'L\'', 'El ', 'La ', 'Els ', 'Les ', 'Los ']
+
+GIVEN_NAMES = ['Joan', 'Josep', 'Maria', 'Mercè', 'Montserrat', 'Pere', 'Jordi', 'Núria', 'Àngel', 'Carme',
+               'José', 'Juan', 'Carmen', 'Pilar', 'Francesc', 'Vicent', 'Rosa', 'Ramon', 'Teresa', 'Llorenç']
+SURNAMES = ['Pérez', 'Garcia', 'García', 'Martí', 'Puig', 'Soler', 'Vidal', 'Ferrer', 'Roca', 'Serra',
+            'Fuster', 'Rodoreda', 'Espriu', 'Sánchez', 'López', 'Català', 'Folch', 'Riba', 'Oller', 'Pla']
+PUBLISHERS = ['Edicions 62', 'Proa', 'Quaderns Crema', 'Anagrama', 'Destino', 'Tres i Quatre', 'Moll',
+              'Columna', 'Empúries', 'Bromera', 'Cátedra', 'Alianza', 'Seix Barral', 'Club Editor']
+CITIES = ['Barcelona', 'València', 'Palma', 'Girona', 'Lleida', 'Tarragona', 'Madrid', 'Perpinyà', 'Alacant']
+SOURCES = ['Biblioteca de Catalunya', 'Arxiu Nacional', 'Fons personal', 'Hemeroteca']
+TYPES = ['book', 'article', 'incollection', 'misc', 'phdthesis']
+
+
+def person(rnd):
+    return f'{rnd.choice(GIVEN_NAMES)} {rnd.choice(SURNAMES)}' + (f' {rnd.choice(SURNAMES)}' if rnd.random() < 0.4 else '')
+
+
+def title(rnd):
+    words = [rnd.choice(TITLE_WORDS)]
+    for _ in range(rnd.randint(0, 4)):
+        words += [rnd.choice(LINK_WORDS), rnd.choice(TITLE_WORDS)]
+    text = ' '.join(words)
+    return rnd.choice(TITLE_PREFIXES) + text[0].upper() + text[1:]
+
+
+def make_record(rnd):
+    doc = {
+        'title': title(rnd),
+        'authors': [person(rnd) for _ in range(rnd.choice((1, 1, 1, 2, 3)))],
+        'source': rnd.choice(SOURCES),
+        'type': rnd.choice(TYPES),
+    }
+    if rnd.random() < 0.85:
+        doc['publisher'] = rnd.choice(PUBLISHERS)
+    if rnd.random() < 0.8:
+        doc['city'] = rnd.choice(CITIES)
+    if rnd.random() < 0.5:
+        doc['pages'] = f'{rnd.randint(1, 300)}-{rnd.randint(301, 600)}'
+    for role in ('editor', 'translator'):
+        if rnd.random() < 0.1:
+            doc[role] = [person(rnd)]
+    # Fechas parciales: sin fecha, solo año, año y mes, o completa
+    kind = rnd.random()
+    if kind >= 0.1:
+        doc['year'] = rnd.randint(1850, 2024)
+    if kind >= 0.4:
+        doc['month'] = rnd.randint(1, 12)
+    if kind >= 0.6:
+        doc['day'] = rnd.randint(1, 28)
+    return doc
+
+
+def generate(count, seed=1):
+    rnd = random.Random(seed)
+    for _ in range(count):
+        doc = make_record(rnd)
+        doc.update(records.derived_fields(doc))
+        yield doc
+
+
+def load(collection, count, seed=1, batch_size=1000):
+    # Sustituye el contenido de la colección por el corpus
+    collection.delete_many({})
+    batch = []
+    for doc in generate(count, seed):
+        batch.append(doc)
+        if len(batch) == batch_size:
+            collection.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
@@ -0,0 +1,235 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import json
+import os
+import platform
+import sys
+import threading
+import time
+from urllib.parse import urlencode
+
+# Benchmark de /search y de los endpoints de vocabulario sobre un corpus sintético
+# cargado en un mongod local (o en mongomock, si está instalado, con --mongomock).
+#
+#   python -m benchmarks.run --docs 20000 --save-baseline
+#   python -m benchmarks.run --docs 20000 --reuse          # compara con la línea base
+#
+# La base de datos de pruebas (--database) se vacía y se vuelve a llenar: no
+# apuntar nunca a la de producción.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(HERE, 'baseline.json')
+DEFAULT_OUTPUT = os.path.join(HERE, 'last_run.json')
+
+SORTS = ['relevance', 'date', 'date-asc', 'title']
+QUERIES = {
+    'browse': {},
+    'query': {'query': 'història'},
+}
+DATE_FILTERS = {
+    'all': {},
+    'range': {'startDate': '1900', 'endDate': '1950'},
+}
+
+
+def scenarios():
+    # nombre -> ruta con parámetros
+    result = {}
+    for sort_by in SORTS:
+        for query_name, query in QUERIES.items():
+            for date_name, dates in DATE_FILTERS.items():
+                params = {**query, **dates, 'sortBy': sort_by, 'limit': 10}
+                result[f'search/{sort_by}/{query_name}/{date_name}'] = '/search?' + urlencode(params)
+    # Páginas profundas y páginas grandes
+    for sort_by in ('date', 'title'):
+        for page in (10, 100):
+            for limit in (10, 50):
+                params = {'sortBy': sort_by, 'page': page, 'limit': limit}
+                result[f'search/{sort_by}/page{page}/limit{limit}'] = '/search?' + urlencode(params)
+    result['search/query/summary'] = '/search?' + urlencode({'query': 'història', 'view': 'summary', 'limit': 50})
+    result['search/query/facets'] = '/search?' + urlencode({'query': 'història', 'facets': 'all'})
+    result['search/query/phrase'] = '/search?' + urlencode({'query': '"història de"'})
+    for path in ('/get_sources', '/get_types', '/get_publishers', '/get_city', '/facets'):
+        result['vocabulary' + path] = path
+    result['autocomplete/title'] = '/autocomplete?' + urlencode({'field': 'title', 'prefix': 'hi'})
+    result['autocomplete/authors'] = '/autocomplete?' + urlencode({'field': 'authors', 'prefix': 'joan p'})
+    return result
+
+
+def percentile(sorted_values, fraction):
+    # Rango más cercano: el valor por debajo del cual queda esa fracción de las muestras
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def run_scenario(app, path, iterations, warmup, concurrency):
+    local = threading.local()
+
+    def request():
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        started = time.perf_counter()
+        response = client.get(path)
+        response.get_data()
+        return time.perf_counter() - started, response.status_code
+
+    for _ in range(warmup):
+        request()
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            samples = list(executor.map(lambda _: request(), range(iterations)))
+    else:
+        samples = [request() for _ in range(iterations)]
+    elapsed = time.perf_counter() - started
+
+    # Las respuestas con error no cuentan para las latencias: un 400 o un 500
+    # rápido haría parecer más rápido el escenario
+    latencies = sorted(seconds * 1000 for seconds, status in samples if status < 400)
+    errors = len(samples) - len(latencies)
+    return {
+        'requests': len(samples),
+        'errors': errors,
+        'failed': errors > 0,
+        'mean_ms': sum(latencies) / len(latencies) if latencies else None,
+        'p50_ms': percentile(latencies, 0.50),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        'rps': len(samples) / elapsed if elapsed else None,
+    }
+
+
+def format_ms(value, width=8):
+    return f"{'-':>{width}}" if value is None else f"{value:{width}.2f}"
+
+
+def compare(results, baseline, threshold):
+    # Devuelve los escenarios cuyo p50 o p95 ha empeorado más de threshold %. Los
+    # escenarios con errores, ahora o en la línea base, no se comparan
+    regressions = []
+    print(f"\n{'scenario':45} {'p50 base':>9} {'p50 now':>9} {'Δ%':>7} {'p95 base':>9} {'p95 now':>9} {'Δ%':>7}")
+    for name, now in results['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if before is None or now.get('failed') or before.get('failed'):
+            continue
+        deltas = {
+            metric: (now[metric] - before[metric]) / before[metric] * 100 if before[metric] else 0.0
+            for metric in ('p50_ms', 'p95_ms')
+        }
+        worse = any(delta > threshold for delta in deltas.values())
+        if worse:
+            regressions.append(name)
+        print(f"{name:45} {before['p50_ms']:9.2f} {now['p50_ms']:9.2f} {deltas['p50_ms']:+7.1f} "
+              f"{before['p95_ms']:9.2f} {now['p95_ms']:9.2f} {deltas['p95_ms']:+7.1f}{'  <-- slower' if worse else ''}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark de /search sobre un corpus sintético')
+    parser.add_argument('--uri', default='mongodb://localhost:27017', help='mongod local para el corpus')
+    parser.add_argument('--database', default='archivo_digital_bench')
+    parser.add_argument('--mongomock', action='store_true', help='usar mongomock en lugar de un mongod')
+    parser.add_argument('--docs', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--reuse', action='store_true', help='no recargar el corpus si ya tiene --docs registros')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--only', default='', help='solo los escenarios que contienen este texto')
+    parser.add_argument('--cache', action='store_true', help='mantener la caché de resultados de /search')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--threshold', type=float, default=10.0, help='%% de empeoramiento que cuenta como regresión')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # La configuración de app se lee al importarlo. Sin Atlas, las búsquedas de
+    # texto usan el índice local; la caché de resultados se desactiva para medir
+    # las búsquedas y no la caché.
+    os.environ['MONGO_URI'] = args.uri
+    os.environ.setdefault('SEARCH_BACKEND', 'local')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ.setdefault('SLOW_SEARCH_MS', '1e9')
+    if not args.cache:
+        os.environ['SEARCH_CACHE_MAX_ENTRIES'] = '0'
+
+    import app as api
+    from benchmarks import corpus
+
+    if args.mongomock:
+        import mongomock
+        api.client = mongomock.MongoClient()
+    api.db = api.client[args.database]
+    api.collection = api.db['bilbiografia_1.0']
+    api.cache_state = api.db['cache_state']
+    if api.shared_vocabulary is not None:
+        api.shared_vocabulary = api.db['vocabulary_cache']
+
+    if not (args.reuse and api.collection.estimated_document_count() == args.docs):
+        started = time.perf_counter()
+        corpus.load(api.collection, args.docs, args.seed)
+        print(f"Loaded {args.docs} documents in {time.perf_counter() - started:.1f}s")
+    api.ensure_indexes()
+    api.invalidate_vocabulary()
+    if hasattr(api.search_backend, 'refresh'):
+        api.search_backend.refresh()
+
+    results = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'docs': args.docs,
+            'seed': args.seed,
+            'iterations': args.iterations,
+            'concurrency': args.concurrency,
+            'search_backend': os.environ['SEARCH_BACKEND'],
+            'cache': args.cache,
+            'storage': 'mongomock' if args.mongomock else 'mongod',
+            'python': platform.python_version(),
+        },
+        'scenarios': {},
+    }
+    print(f"{'scenario':45} {'p50':>8} {'p95':>8} {'p99':>8} {'req/s':>8} {'errors':>6}")
+    for name, path in scenarios().items():
+        if args.only not in name:
+            continue
+        stats = run_scenario(api.app, path, args.iterations, args.warmup, args.concurrency)
+        results['scenarios'][name] = stats
+        print(f"{name:45} {format_ms(stats['p50_ms'])} {format_ms(stats['p95_ms'])} {format_ms(stats['p99_ms'])} "
+              f"{stats['rps']:8.1f} {stats['errors']:6}{'  <-- FAILED' if stats['failed'] else ''}")
+
+    with open(args.output, 'w', encoding='utf-8') as handle:
+        json.dump(results, handle, indent=2)
+    print(f"\nResults written to {args.output}")
+    failed = [name for name, stats in results['scenarios'].items() if stats['failed']]
+    if failed:
+        print(f"{len(failed)} scenario(s) failed with error responses: {', '.join(failed)}")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as handle:
+            json.dump(results, handle, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 1 if failed else 0
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as handle:
+            baseline = json.load(handle)
+        if baseline['meta'].get('docs') != args.docs:
+            print(f"Warning: baseline has {baseline['meta'].get('docs')} documents, this run {args.docs}")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} scenario(s) slower than the baseline by more than {args.threshold}%")
+            return 1
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,81 @@
+import csv
+import io
+import json
+
+import bibtexparser
+from bibtexparser.model import Entry, Field
+
+# Formatos de /search/export: cada función recibe un lote de documentos ya
+# serializados (serialize_document) y devuelve el texto de ese lote.
+
+CSV_FIELDS = [
+    '_id', 'title', 'authors', 'editor', 'translator', 'illustrator', 'coordinator', 'director',
+    'date', 'year', 'month', 'day', 'source', 'type', 'publisher', 'city', 'pages', 'book', 'folder_names',
+]
+
+BIBTEX_TYPES = {'article', 'book', 'booklet', 'inbook', 'incollection', 'inproceedings', 'manual',
+                'mastersthesis', 'misc', 'phdthesis', 'proceedings', 'techreport', 'unpublished'}
+
+BIBTEX_FIELDS = [
+    ('title', 'title'),
+    ('authors', 'author'),
+    ('editor', 'editor'),
+    ('translator', 'translator'),
+    ('illustrator', 'illustrator'),
+    ('coordinator', 'coordinator'),
+    ('director', 'director'),
+    ('book', 'booktitle'),
+    ('publisher', 'publisher'),
+    ('city', 'address'),
+    ('year', 'year'),
+    ('month', 'month'),
+    ('day', 'day'),
+    ('pages', 'pages'),
+    ('source', 'source'),
+]
+
+
+def _flatten(value, separator):
+    # Las personas llegan como [{'name': ...}] desde serialize_document
+    if isinstance(value, list):
+        return separator.join(str(item['name'] if isinstance(item, dict) else item) for item in value)
+    return value
+
+
+def render_ndjson(docs):
+    return ''.join(json.dumps(doc, ensure_ascii=False, default=str) + '\n' for doc in docs)
+
+
+def csv_header():
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(CSV_FIELDS)
+    return buffer.getvalue()
+
+
+def render_csv(docs):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for doc in docs:
+        writer.writerow([_flatten(doc.get(field), '; ') for field in CSV_FIELDS])
+    return buffer.getvalue()
+
+
+def render_bibtex(docs):
+    entries = []
+    for doc in docs:
+        entry_type = str(doc.get('type') or '').lower()
+        fields = [
+            Field(bibtex_field, str(_flatten(doc[field], ' and ')))
+            for field, bibtex_field in BIBTEX_FIELDS
+            if doc.get(field) not in (None, '', [])
+        ]
+        entries.append(Entry(entry_type if entry_type in BIBTEX_TYPES else 'misc', doc['_id'], fields))
+    return bibtexparser.write_string(bibtexparser.Library(entries)) + '\n'
+
+
+# formato -> (mimetype, extensión, cabecera, función de renderizado)
+FORMATS = {
+    'ndjson': ('application/x-ndjson', 'ndjson', None, render_ndjson),
+    'csv': ('text/csv', 'csv', csv_header, render_csv),
+    'bibtex': ('application/x-bibtex', 'bib', None, render_bibtex),
+}
@@ -0,0 +1,23 @@
+import os
+
+# gunicorn lee este fichero automáticamente desde el directorio de trabajo
+# (Procfile: gunicorn app:app). Con GUNICORN_PRELOAD=1 la aplicación se importa
+# una sola vez en el proceso maestro y los workers arrancan más rápido.
+preload_app = os.getenv("GUNICORN_PRELOAD") == "1"
+
+# Workers con hilos (gthread): cada worker atiende GUNICORN_THREADS peticiones a
+# la vez, que pasan casi todo el tiempo esperando a Atlas y sueltan el GIL
+# mientras tanto. El número de workers se fija con WEB_CONCURRENCY (o --workers).
+# Cada hilo usa una conexión del pool de MongoClient: MONGO_MAX_POOL_SIZE (100 por
+# defecto) tiene que ser mayor que GUNICORN_THREADS más QUERY_WORKERS.
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", 32))
+
+
+def post_worker_init(worker):
+    # Cada worker crea su propio cliente de MongoDB (el del maestro no sirve tras
+    # el fork) y se calienta en segundo plano; /healthz responde 503 hasta entonces
+    import app
+
+    app.connect()
+    app.start_warm_up()
@@ -0,0 +1,206 @@
+import hashlib
+import json
+import os
+import re
+
+import bibtexparser
+import pandas as pd
+from pymongo import UpdateOne
+
+import export
+import records
+
+# Carga masiva de registros desde BibTeX, CSV o JSON/NDJSON. Los ficheros se leen
+# por trozos, cada registro se valida y normaliza, se le calculan los campos
+# derivados (records.derived_fields) y se escribe con upserts sin orden por lotes.
+# El hash del contenido hace que cargar dos veces el mismo registro no lo duplique.
+
+BATCH_SIZE = 1000
+
+# Campo BibTeX -> campo del registro (el inverso de la exportación)
+BIBTEX_FIELDS = {bibtex_field: field for field, bibtex_field in export.BIBTEX_FIELDS}
+
+MONTHS = {name: number for number, name in enumerate(
+    ('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'), start=1)}
+
+DATE_LIMITS = {'year': (1, 9999), 'month': (1, 12), 'day': (1, 31)}
+
+# Campos que se calculan aquí y no se aceptan de la entrada
+COMPUTED_FIELDS = ('_id', 'content_hash', 'date', 'sort_title', 'sort_date', 'sort_undated', 'date_lo', 'date_hi')
+
+_SPACES = re.compile(r'\s+')
+# Inicio de un bloque BibTeX (@book{, @string{...) y bloques que no son registros
+_BIBTEX_BLOCK = re.compile(r'\s*@\s*(\w+)')
+_BIBTEX_NON_ENTRIES = ('string', 'comment', 'preamble')
+
+
+class InvalidRecord(ValueError):
+    pass
+
+
+def read_bibtex(path, chunk_size=BATCH_SIZE):
+    # Se analizan trozos de chunk_size entradas para no cargar el fichero entero
+    def parse(text):
+        for entry in bibtexparser.parse_string(text).entries:
+            raw = {'type': entry.entry_type}
+            for field in entry.fields:
+                if field.key.lower() in BIBTEX_FIELDS:
+                    # Las llaves internas solo protegen mayúsculas en BibTeX
+                    value = field.value.replace('{', '').replace('}', '')
+                    name = BIBTEX_FIELDS[field.key.lower()]
+                    raw[name] = value.split(' and ') if name in records.PERSON_FIELDS else value
+            yield raw
+
+    # Las macros @string se repiten al principio de cada trozo: pueden usarse en
+    # entradas de cualquier trozo posterior. @string, @comment y @preamble no
+    # cuentan como entradas
+    macros, lines, entries = [], [], 0
+    block = lines
+    with open(path, encoding='utf-8') as handle:
+        for line in handle:
+            start = _BIBTEX_BLOCK.match(line)
+            if start:
+                kind = start.group(1).lower()
+                if kind not in _BIBTEX_NON_ENTRIES:
+                    if entries == chunk_size:
+                        yield from parse(''.join(macros + lines))
+                        lines, entries = [], 0
+                    entries += 1
+                block = macros if kind == 'string' else lines
+            block.append(line)
+    if lines:
+        yield from parse(''.join(macros + lines))
+
+
+def read_csv(path, chunk_size=BATCH_SIZE):
+    # Mismas columnas que la exportación CSV; las personas separadas por ';'
+    for chunk in pd.read_csv(path, chunksize=chunk_size, dtype=str, keep_default_na=False):
+        for raw in chunk.to_dict('records'):
+            for field in records.PERSON_FIELDS:
+                if raw.get(field):
+                    raw[field] = raw[field].split(';')
+            yield raw
+
+
+def read_json(path):
+    # NDJSON (un registro por línea) o un array JSON. El array se carga entero en
+    # memoria con json.load: para volcados grandes, mejor NDJSON, que se lee por líneas
+    with open(path, encoding='utf-8') as handle:
+        if path.endswith(('.ndjson', '.jsonl')):
+            for line in handle:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            data = json.load(handle)
+            yield from data if isinstance(data, list) else data.get('results', [])
+
+
+READERS = {
+    'bibtex': read_bibtex,
+    'csv': read_csv,
+    'json': read_json,
+}
+
+EXTENSIONS = {
+    '.bib': 'bibtex',
+    '.bibtex': 'bibtex',
+    '.csv': 'csv',
+    '.json': 'json',
+    '.jsonl': 'json',
+    '.ndjson': 'json',
+}
+
+
+def clean_text(value):
+    return _SPACES.sub(' ', str(value)).strip()
+
+
+def clean_people(value):
+    # Acepta listas de nombres, [{'name': ...}] (exportación JSON) o texto con ';'
+    if isinstance(value, str):
+        value = value.split(';')
+    names = (person.get('name') if isinstance(person, dict) else person for person in value or [])
+    return [clean_text(name) for name in names if name is not None and clean_text(name)]
+
+
+def clean_date_part(field, value):
+    if field == 'month' and isinstance(value, str) and value.strip().lower()[:3] in MONTHS:
+        return MONTHS[value.strip().lower()[:3]]
+    try:
+        number = int(float(value))
+    except (TypeError, ValueError):
+        raise InvalidRecord(f"Invalid {field}: {value!r}")
+    low, high = DATE_LIMITS[field]
+    if not low <= number <= high:
+        raise InvalidRecord(f"Invalid {field}: {value!r}")
+    return number
+
+
+def normalize(raw):
+    # Registro limpio (sin vacíos, textos sin espacios sobrantes, fecha en enteros)
+    # o InvalidRecord si no se puede cargar
+    doc = {}
+    for field, value in raw.items():
+        if field in COMPUTED_FIELDS or value is None or (isinstance(value, float) and value != value):
+            continue
+        if field in records.PERSON_FIELDS:
+            value = clean_people(value)
+        elif field in DATE_LIMITS:
+            value = None if str(value).strip() == '' else clean_date_part(field, value)
+        elif isinstance(value, str):
+            value = clean_text(value)
+        if value not in (None, '', []):
+            doc[field] = value
+    if not isinstance(doc.get('title'), str) or not doc['title']:
+        raise InvalidRecord("Missing title")
+    return doc
+
+
+def content_hash(doc):
+    content = json.dumps(doc, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def detect_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in EXTENSIONS:
+        raise ValueError(f"Unknown file format: {path}")
+    return EXTENSIONS[extension]
+
+
+def ingest_file(collection, path, file_format=None, batch_size=BATCH_SIZE):
+    # Devuelve un resumen {read, invalid, duplicates, inserted, existing, errors}
+    reader = READERS[file_format or detect_format(path)]
+    stats = {'read': 0, 'invalid': 0, 'duplicates': 0, 'inserted': 0, 'existing': 0, 'errors': []}
+    seen = set()
+    operations = []
+
+    def flush():
+        result = collection.bulk_write(operations, ordered=False)
+        stats['inserted'] += result.upserted_count
+        stats['existing'] += result.matched_count
+        operations.clear()
+
+    for raw in reader(path):
+        stats['read'] += 1
+        try:
+            doc = normalize(raw)
+        except InvalidRecord as e:
+            stats['invalid'] += 1
+            if len(stats['errors']) < 20:
+                stats['errors'].append(f"record {stats['read']}: {e}")
+            continue
+        digest = content_hash(doc)
+        if digest in seen:
+            stats['duplicates'] += 1
+            continue
+        seen.add(digest)
+        doc.update(records.derived_fields(doc))
+        doc['content_hash'] = digest
+        # Si ya existe un registro con el mismo contenido no se toca
+        operations.append(UpdateOne({'content_hash': digest}, {'$setOnInsert': doc}, upsert=True))
+        if len(operations) == batch_size:
+            flush()
+    if operations:
+        flush()
+    return stats
@@ -0,0 +1,108 @@
+from bisect import bisect_left
+from contextvars import ContextVar
+import threading
+import time
+
+# Métricas en memoria del proceso, expuestas en /metrics con el formato de texto
+# de Prometheus, y cronometraje por fases de cada búsqueda.
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+
+    def __init__(self):
+        self._histograms = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, help_text='', **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+                self._help.setdefault(name, help_text)
+            histogram.observe(value)
+
+    def render(self, gauges=None):
+        # gauges: {nombre: valor} adicionales (p. ej. estadísticas de la caché)
+        lines = []
+        with self._lock:
+            for name in sorted(self._help):
+                lines.append(f'# HELP {name} {self._help[name]}')
+                lines.append(f'# TYPE {name} histogram')
+                for (key_name, labels), histogram in sorted(self._histograms.items()):
+                    if key_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(self.bucket_labels(histogram), histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{_labels(labels, le=bound)} {cumulative}')
+                    lines.append(f'{name}_sum{_labels(labels)} {histogram.sum}')
+                    lines.append(f'{name}_count{_labels(labels)} {histogram.count}')
+        for name, value in sorted((gauges or {}).items()):
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def bucket_labels(histogram):
+        return [repr(bound) for bound in histogram.buckets] + ['+Inf']
+
+
+def _labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for _, value in items)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(items, escaped)) + '}'
+
+
+registry = Registry()
+
+
+class PhaseTimer:
+    # Cada lap() asigna a la fase indicada el tiempo transcurrido desde el anterior
+
+    def __init__(self):
+        self.start = self._last = time.perf_counter()
+        self.phases = {}
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self._last
+        self._last = now
+
+    def total(self):
+        return time.perf_counter() - self.start
+
+
+_current_timer = ContextVar('phase_timer', default=None)
+
+
+def start_timer():
+    timer = PhaseTimer()
+    _current_timer.set(timer)
+    return timer
+
+
+def lap(phase):
+    # Sin temporizador activo (CLI, exportación...) no hace nada
+    timer = _current_timer.get()
+    if timer is not None:
+        timer.lap(phase)
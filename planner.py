@@ -0,0 +1,389 @@
+from datetime import datetime
+from functools import lru_cache
+import base64
+import logging
+import os
+import re
+
+from bson import json_util
+
+import metrics
+import records
+from search_backends import DEFAULT_FIELDS
+
+# Planificador de /search: valida y normaliza los parámetros antes de hacer
+# ningún trabajo y construye las etapas de la agregación. Las partes que no
+# dependen de la petición (ordenaciones, proyecciones, recuentos por valor) se
+# calculan una vez y se comparten entre peticiones, así que nunca se modifican:
+# quien necesite otra versión crea un diccionario nuevo.
+
+logger = logging.getLogger(__name__)
+
+MAX_LIMIT = int(os.getenv("SEARCH_MAX_LIMIT", 100))
+# Más allá de esta posición hay que paginar con cursor en lugar de con page
+MAX_OFFSET = int(os.getenv("SEARCH_MAX_OFFSET", 10000))
+MAX_QUERY_LENGTH = 500
+
+SEARCH_TYPES = ('', 'and', 'or', 'mustnot')
+COUNT_MODES = ('exact', 'estimate', 'none')
+MATCH_FIELDS = ('source', 'type', 'publisher', 'city')
+
+# Ordenación con los campos sort_title / sort_date guardados en cada registro
+# (ver records.derived_fields y el comando `flask backfill-fields`)
+SORT_ORDERS = {
+    'date': (
+        ('sort_undated', 1),  # Los registros sin fecha van al final
+        ('sort_date', -1),  # Ordenar por fecha descendente
+        ('_id', -1),  # Desempate para mantener un orden estable
+    ),
+    'date-asc': (
+        ('sort_undated', 1),
+        ('sort_date', 1),
+        ('_id', 1),
+    ),
+    'title': (('sort_title', 1), ('_id', 1)),
+    'title-desc': (('sort_title', -1), ('_id', -1)),
+    # Sin texto de búsqueda no hay relevancia que ordenar
+    'relevance': (('_id', 1),),
+}
+SORT_STAGES = {sort_by: {'$sort': dict(order)} for sort_by, order in SORT_ORDERS.items()}
+
+# Campos derivados de uso interno (ordenación, filtros, paginación)
+INTERNAL_FIELDS = ('sort_title', 'sort_date', 'sort_undated', 'date_lo', 'date_hi', 'search_token', 'content_hash')
+# Columnas que muestra la lista de resultados (view=summary)
+SUMMARY_FIELDS = ('title', 'authors', 'date', 'source', 'type', 'publisher', 'city')
+# El texto de 'date' se construye a partir de estos campos si el registro no lo trae
+DATE_FIELDS = ('year', 'month', 'day')
+
+# Recuentos por valor que acompañan a los resultados con facets=
+FACET_FIELDS = {
+    'source': 'source',
+    'type': 'type',
+    'publisher': 'publisher',
+    'city': 'city',
+}
+FACET_MAX_VALUES = int(os.getenv("FACET_MAX_VALUES", 100))
+
+_FIELD_NAME = re.compile(r'^[A-Za-z_]\w*$')
+_YEAR = re.compile(r'^\d{4}$')
+
+
+class InvalidParameter(ValueError):
+    pass
+
+
+class InvalidCursor(InvalidParameter):
+    pass
+
+
+def is_true(value):
+    return str(value or '').lower() in ('1', 'true', 'yes')
+
+
+def text_param(args, name, default=''):
+    value = args.get(name)
+    return default if value is None else str(value).strip()
+
+
+def int_param(args, name, default, minimum, maximum=None):
+    value = args.get(name)
+    if value in (None, ''):
+        return default
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise InvalidParameter(f"{name} must be an integer")
+    if number < minimum or (maximum is not None and number > maximum):
+        limits = f"between {minimum} and {maximum}" if maximum is not None else f"at least {minimum}"
+        raise InvalidParameter(f"{name} must be {limits}")
+    return number
+
+
+def choice_param(args, name, choices, default):
+    value = text_param(args, name, default).lower()
+    if value not in choices:
+        raise InvalidParameter(f"Unsupported {name}: {value}")
+    return value
+
+
+def date_param(args, name, end=False):
+    # aaaa (todo el año) o dd/mm/aaaa
+    value = text_param(args, name)
+    if not value:
+        return None
+    if _YEAR.match(value):
+        value = f'31/12/{value}' if end else f'01/01/{value}'
+    try:
+        return datetime.strptime(value, '%d/%m/%Y')
+    except ValueError:
+        raise InvalidParameter(f"{name} must be yyyy or dd/mm/yyyy")
+
+
+def search_field_param(args, name):
+    value = text_param(args, name)
+    if value and value not in DEFAULT_FIELDS:
+        raise InvalidParameter(f"Unsupported {name}: {value}")
+    return value
+
+
+def return_fields_param(args):
+    # Campos de salida o None para el documento completo
+    return_fields = args.get('return_fields') or args.get('returnFields')
+    view = choice_param(args, 'view', ('summary', 'full'), 'full')
+    if return_fields:
+        fields = return_fields if isinstance(return_fields, list) else str(return_fields).split(',')
+        fields = tuple(field.strip() for field in fields if field.strip())
+        invalid = [field for field in fields if not _FIELD_NAME.match(field)]
+        if invalid:
+            raise InvalidParameter(f"Invalid return_fields: {', '.join(invalid)}")
+        return fields
+    return SUMMARY_FIELDS if view == 'summary' else None
+
+
+def parse_facets(value):
+    # facets=source,type,decade; facets=1 o facets=all pide todos. En /search/batch
+    # también puede ser una lista JSON
+    if not value:
+        return ()
+    values = value if isinstance(value, list) else str(value).split(',')
+    names = [str(name).strip() for name in values if str(name).strip()]
+    if len(names) == 1 and (names[0].lower() == 'all' or is_true(names[0])):
+        return tuple(FACET_FIELDS) + ('decade',)
+    invalid = [name for name in names if name not in FACET_FIELDS and name != 'decade']
+    if invalid:
+        raise InvalidParameter(f"Unsupported facets: {', '.join(invalid)}")
+    return tuple(dict.fromkeys(names))
+
+
+def parse_params(args):
+    # Parámetros de /search validados y normalizados; InvalidParameter (400) si
+    # alguno no es válido
+    params = {
+        'query': text_param(args, 'query'),
+        'optional_query': text_param(args, 'optionalQuery'),
+        'search_type': choice_param(args, 'searchTypeValue', SEARCH_TYPES, ''),
+        'fields': search_field_param(args, 'fields'),
+        'fields2': search_field_param(args, 'fields2'),
+        'match_filter': {field: text_param(args, field) for field in MATCH_FIELDS if text_param(args, field)},
+        'start_date': date_param(args, 'startDate'),
+        'end_date': date_param(args, 'endDate', end=True),
+        'sort_by': choice_param(args, 'sortBy', tuple(SORT_ORDERS), 'relevance'),
+        'page': int_param(args, 'page', 1, 1),
+        'limit': int_param(args, 'limit', 10, 1, MAX_LIMIT),
+        'count_mode': choice_param(args, 'count', COUNT_MODES, 'exact'),
+        'cursor': text_param(args, 'cursor') or None,
+        'include_score': is_true(args.get('includeScore')),
+        'return_fields': return_fields_param(args),
+        'facets': parse_facets(args.get('facets')),
+        'explain': is_true(args.get('explain')),
+    }
+    for name in ('query', 'optional_query'):
+        if len(params[name]) > MAX_QUERY_LENGTH:
+            raise InvalidParameter(f"{name} is longer than {MAX_QUERY_LENGTH} characters")
+    if params['start_date'] and params['end_date'] and params['start_date'] > params['end_date']:
+        raise InvalidParameter("startDate is after endDate")
+    if (params['page'] - 1) * params['limit'] > MAX_OFFSET:
+        raise InvalidParameter(f"page is too deep (more than {MAX_OFFSET} results); use cursor instead")
+    return params
+
+
+def encode_cursor(cursor_fields, sort_by, doc):
+    # Cursor opaco con los valores de ordenación del último documento devuelto
+    values = [doc.get(field) for field in cursor_fields]
+    payload = json_util.dumps({'sort': sort_by, 'values': values})
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, sort_by):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json_util.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+        values = payload['values']
+    except Exception:
+        raise InvalidCursor("Malformed cursor")
+    if payload.get('sort') != sort_by:
+        raise InvalidCursor("Cursor was created for a different sortBy")
+    return values
+
+
+def build_keyset_match(sort_order, values):
+    # (a, b) > (va, vb)  <=>  a > va  OR  (a == va AND b > vb)
+    if len(values) != len(sort_order):
+        raise InvalidCursor("Cursor does not match the sort order")
+    clauses = []
+    for i, (field, direction) in enumerate(sort_order):
+        clause = {prev_field: values[j] for j, (prev_field, _) in enumerate(sort_order[:i])}
+        clause[field] = {'$gt' if direction == 1 else '$lt': values[i]}
+        clauses.append(clause)
+    return {'$match': {'$or': clauses}}
+
+
+@lru_cache(maxsize=256)
+def build_projection(fields, cursor_fields, include_score):
+    # Devuelve ($project, campos que solo hacen falta para la fecha o el cursor
+    # y se quitan al serializar)
+    if fields is None:
+        hidden = tuple(field for field in cursor_fields if field in INTERNAL_FIELDS)
+        projection = {field: 0 for field in INTERNAL_FIELDS if field not in cursor_fields}
+        return projection, hidden
+
+    output = set(fields) | {'_id'}
+    if include_score:
+        output.add('score')
+    projection = {field: 1 for field in output}
+    if 'date' in output:
+        projection.update({field: 1 for field in DATE_FIELDS})
+    projection.update({field: 1 for field in cursor_fields})
+    return projection, tuple(field for field in projection if field not in output)
+
+
+@lru_cache(maxsize=64)
+def build_facet_pipelines(names):
+    facets = {}
+    for name in names:
+        if name == 'decade':
+            # date_lo es yyyymmdd: la década es yyyymmdd // 100000 * 10
+            facets[name] = [
+                {'$match': {'date_lo': {'$ne': None}}},
+                {'$group': {'_id': {'$multiply': [{'$floor': {'$divide': ['$date_lo', 100000]}}, 10]},
+                            'count': {'$sum': 1}}},
+                {'$sort': {'_id': 1}},
+            ]
+        else:
+            field = FACET_FIELDS[name]
+            # Como $sortByCount, pero con desempate por valor para que el orden sea estable
+            facets[name] = [
+                {'$unwind': f'${field}'},
+                {'$group': {'_id': f'${field}', 'count': {'$sum': 1}}},
+                {'$sort': {'count': -1, '_id': 1}},
+                {'$limit': FACET_MAX_VALUES},
+            ]
+    return facets
+
+
+def build_search_plan(args, search_backend):
+    # Interpreta los parámetros de /search y construye las etapas comunes a la
+    # página de resultados y a la exportación completa
+    params = parse_params(args)
+    query, optional_query = params['query'], params['optional_query']
+    match_filter = params['match_filter']
+    sort_by, cursor = params['sort_by'], params['cursor']
+    page, limit = params['page'], params['limit']
+    skip = (page - 1) * limit
+
+    logger.debug("Search parameters: %s", params)
+    metrics.lap('parse_params')
+
+    # Se compara con los límites date_lo/date_hi (yyyymmdd) guardados en cada registro:
+    # sin mes/día, date_lo usa el 1 y date_hi el 12/31. Los registros sin año no
+    # tienen límites y quedan fuera.
+    date_range = {}
+    if params['start_date']:
+        date_range['date_lo'] = {'$gte': records.date_key(params['start_date'])}
+    if params['end_date']:
+        date_range['date_hi'] = {'$lte': records.date_key(params['end_date'])}
+
+    query_pipeline = []
+    ranked = None
+    post_filter = match_filter
+    if query or optional_query:
+        spec = {
+            'query': query,
+            'optional_query': optional_query,
+            'search_type': params['search_type'],
+            'fields': params['fields'],
+            'fields2': params['fields2'],
+        }
+        # Atlas filtra las fechas y los campos de search_backend.filter_fields dentro
+        # de $search; el índice local aplica todos los filtros y devuelve los
+        # resultados ya ordenados por relevancia
+        metrics.lap('build_pipeline')
+        search_stage, ranked = search_backend.search(spec, match_filter, date_range)
+        metrics.lap('text_search')
+        query_pipeline.append(search_stage)
+        if '$search' in search_stage:
+            post_filter = {field: value for field, value in match_filter.items()
+                           if field not in search_backend.filter_fields}
+
+    has_search = bool(query_pipeline) and '$search' in query_pipeline[0]
+
+    if date_range and not has_search:
+        query_pipeline.append({"$match": date_range})
+
+    if post_filter:
+        query_pipeline.append({"$match": post_filter})
+
+    count_mode = params['count_mode']
+    if cursor:
+        # El total ya lo tiene el cliente desde la primera página; recalcularlo
+        # obligaría a recorrer todos los resultados en cada página
+        count_mode = 'none'
+
+    if sort_by == 'relevance' and (has_search or ranked is not None):
+        # Relevancia: $search (o el índice local) ya devuelve los documentos por
+        # puntuación, así que no se añade ninguna etapa $sort (que además
+        # obligaría a ordenar en memoria)
+        sort_order = None
+    else:
+        sort_order = SORT_ORDERS[sort_by]
+
+    sort_stages = []
+    cursor_stages = []
+    offset = skip
+    if sort_order is None and ranked is not None:
+        # Índice local: el cursor guarda la posición en la lista ya ordenada
+        cursor_fields = ('offset',)
+        if cursor:
+            position = decode_cursor(cursor, sort_by)
+            if len(position) != 1 or not isinstance(position[0], int):
+                raise InvalidCursor("Cursor does not match the sort order")
+            offset = position[0]
+    elif sort_order is None:
+        # El cursor guarda el token de paginación de Atlas Search del último documento
+        # y la página siguiente continúa con searchAfter dentro del propio $search.
+        # $meta se lee antes del $facet, que ya no conserva los metadatos de $search
+        cursor_fields = ('search_token',)
+        cursor_stages.append({"$addFields": {"search_token": {"$meta": "searchSequenceToken"}}})
+        if cursor:
+            token = decode_cursor(cursor, sort_by)
+            if len(token) != 1 or not isinstance(token[0], str):
+                raise InvalidCursor("Cursor does not match the sort order")
+            query_pipeline[0] = {'$search': dict(query_pipeline[0]['$search'], searchAfter=token[0])}
+    else:
+        cursor_fields = tuple(field for field, _ in sort_order)
+        if cursor:
+            # Paginación por cursor: se continúa desde la última clave en lugar de usar $skip
+            sort_stages.append(build_keyset_match(sort_order, decode_cursor(cursor, sort_by)))
+        sort_stages.append(SORT_STAGES[sort_by])
+
+    include_score = params['include_score']
+    if has_search and include_score:
+        query_pipeline.append({"$addFields": {"score": {"$meta": "searchScore"}}})
+
+    projection, hidden_fields = build_projection(params['return_fields'], cursor_fields, include_score)
+
+    logger.debug("Search pipeline: %s", query_pipeline)
+    metrics.lap('build_pipeline')
+
+    return {
+        'query_pipeline': query_pipeline,
+        'sort_stages': sort_stages,
+        'cursor_stages': cursor_stages,
+        'cursor_fields': cursor_fields,
+        'sort_by': sort_by,
+        'has_search': has_search,
+        'ranked': ranked if sort_order is None else None,
+        'include_score': include_score,
+        'projection': projection,
+        'output_fields': frozenset(params['return_fields']) if params['return_fields'] is not None else None,
+        'hidden_fields': hidden_fields,
+        'has_post_filters': bool(post_filter or (date_range and not has_search) or ranked is not None),
+        'count_mode': count_mode,
+        'facets': params['facets'],
+        'cursor': cursor,
+        'page': page,
+        'limit': limit,
+        'skip': skip,
+        'offset': offset,
+        'explain': params['explain'],
+    }
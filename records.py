@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta
+import re
+import unicodedata
+
+# Campos calculados al escribir cada registro para poder ordenar y filtrar por
+# fecha con índices en lugar de recalcularlos en cada búsqueda.
+SOURCE_FIELDS = ('title', 'year', 'month', 'day')
+# Campos con listas de personas
+PERSON_FIELDS = ('authors', 'editor', 'translator', 'illustrator', 'coordinator', 'director')
+
+_FIRST_LETTER = re.compile(r'[^\W\d_]')
+
+
+def fold_text(text):
+    # Quita tildes y diacríticos de cualquier letra (no solo de las vocales) y
+    # pasa a minúsculas para comparar sin distinguir mayúsculas
+    if not text:
+        return ''
+    decomposed = unicodedata.normalize('NFKD', str(text))
+    stripped = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return stripped.casefold()
+
+
+def sort_title(title):
+    # Igual que antes: se ordena a partir del primer carácter alfabético,
+    # ignorando comillas, signos y números iniciales
+    folded = fold_text(title)
+    match = _FIRST_LETTER.search(folded)
+    return folded[match.start():] if match else folded
+
+
+def sort_date(doc):
+    # Solo las fechas completas cuentan para ordenar por fecha
+    year, month, day = doc.get('year'), doc.get('month'), doc.get('day')
+    if year is None or month is None or day is None:
+        return None
+    try:
+        # Como $dateFromParts, un día fuera de rango pasa al mes siguiente
+        return datetime(int(year), int(month), 1) + timedelta(days=int(day) - 1)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def date_key(date):
+    return date.year * 10000 + date.month * 100 + date.day
+
+
+def date_bounds(doc):
+    # Primer y último día (yyyymmdd) que puede representar una fecha parcial:
+    # sin mes/día se toma el 1 para el inicio y el 12/31 para el final
+    year, month, day = doc.get('year'), doc.get('month'), doc.get('day')
+    if year is None:
+        return None, None
+    try:
+        year = int(year)
+        low = year * 10000 + int(month if month is not None else 1) * 100 + int(day if day is not None else 1)
+        high = year * 10000 + int(month if month is not None else 12) * 100 + int(day if day is not None else 31)
+    except (TypeError, ValueError):
+        return None, None
+    return low, high
+
+
+def display_date(doc):
+    # Texto de la fecha tal como se muestra (dd/mm/aaaa, mm/aaaa, dd/mm o aaaa)
+    if 'year' in doc and 'month' in doc and 'day' in doc:
+        return f"{doc['day']:02d}/{doc['month']:02d}/{doc['year']}"
+    elif 'year' in doc and 'month' in doc:
+        return f"{doc['month']:02d}/{doc['year']}"
+    elif 'day' in doc and 'month' in doc:
+        return f"{doc['day']:02d}/{doc['month']:02d}"
+    elif 'year' in doc:
+        return f"{doc['year']}"
+    return None
+
+
+def derived_fields(doc):
+    date = sort_date(doc)
+    date_lo, date_hi = date_bounds(doc)
+    return {
+        'date': display_date(doc),
+        'sort_title': sort_title(doc.get('title')),
+        'sort_date': date,
+        # Los registros sin fecha van siempre al final, en ambos sentidos
+        'sort_undated': date is None,
+        'date_lo': date_lo,
+        'date_hi': date_hi,
+    }
@@ -0,0 +1,392 @@
+from collections import defaultdict
+from functools import lru_cache
+import json
+import math
+import os
+import re
+import threading
+
+from records import fold_text
+
+# Motores de búsqueda de texto para /search:
+#   - AtlasSearchBackend: etapa $search de MongoDB Atlas (por defecto)
+#   - LocalSearchBackend: índice invertido en memoria, para un mongod normal,
+#     para pruebas sin conexión o para no pagar la ida y vuelta a Atlas
+# Ambos reciben la misma especificación (query, optionalQuery, searchTypeValue,
+# fields, fields2) y los mismos filtros, y devuelven la etapa con la que empieza
+# la agregación.
+
+DEFAULT_FIELDS = ["title", "source", "authors", "editor", "folder_names", "publisher", "translator", "illustrator", "coordinator", "director", "city", "book"]
+
+# Peso de cada campo en la relevancia (p. ej. una coincidencia en el título puntúa
+# más que una en folder_names); se configura en el servidor con SEARCH_BOOSTS
+SEARCH_BOOSTS = json.loads(os.getenv("SEARCH_BOOSTS", '{"title": 3, "authors": 2}'))
+
+# Campos que Atlas filtra dentro de $search con "equals" en lugar de con un $match
+# posterior (p. ej. SEARCH_INDEX_FILTER_FIELDS=source,type,city). Desactivado por
+# defecto: el índice "default" usa el mapeo dinámico, y equals sobre un texto solo
+# funciona si el campo está mapeado también como token; sin ese mapeo la búsqueda
+# falla o no devuelve nada. Antes de activarlo, añadir al índice por cada campo:
+#   "source": [{"type": "string"}, {"type": "token"}]
+INDEX_FILTER_FIELDS = tuple(
+    field.strip() for field in os.getenv("SEARCH_INDEX_FILTER_FIELDS", "").split(',') if field.strip())
+
+
+def parse_query(query):
+    # Una consulta entre comillas es una frase exacta; si no, texto con fuzzy
+    if query and query.startswith('"') and query.endswith('"'):
+        return "phrase", query.strip('"')
+    return "text", query
+
+
+def build_operator(operator_type, query, path):
+    # Operador text/phrase de Atlas Search sobre uno o varios campos
+    operator = {operator_type: {"query": query, "path": path}}
+    if operator_type == "text":
+        operator[operator_type]["fuzzy"] = {"maxEdits": 1}
+
+    paths = path if isinstance(path, list) else [path]
+    boosted = [field for field in paths if field in SEARCH_BOOSTS]
+    if len(paths) < 2 or not boosted:
+        return operator
+
+    # Atlas solo permite un boost por operador: se separan los campos con peso
+    # propio y basta con que coincida cualquiera de ellos, como antes
+    clauses = []
+    for field in boosted:
+        clause = {operator_type: dict(operator[operator_type], path=field)}
+        clause[operator_type]["score"] = {"boost": {"value": SEARCH_BOOSTS[field]}}
+        clauses.append(clause)
+    rest = [field for field in paths if field not in SEARCH_BOOSTS]
+    if rest:
+        clauses.append({operator_type: dict(operator[operator_type], path=rest)})
+    return {"compound": {"should": clauses, "minimumShouldMatch": 1}}
+
+
+def add_search_filters(search_stage, clauses):
+    # Añade cláusulas "filter" (no puntúan) a una etapa $search, envolviendo el
+    # operador en un compound si todavía no lo es
+    search = dict(search_stage['$search'])
+    if 'compound' in search:
+        compound = dict(search['compound'])
+        if 'should' in compound and 'must' not in compound:
+            # Con filter, Atlas deja de exigir al menos un should por defecto
+            compound.setdefault('minimumShouldMatch', 1)
+    else:
+        operator = next(key for key in search if key not in ('index', 'count'))
+        compound = {'must': [{operator: search.pop(operator)}]}
+    compound['filter'] = compound.get('filter', []) + clauses
+    search['compound'] = compound
+    return {'$search': search}
+
+
+SPEC_KEYS = ('query', 'optional_query', 'search_type', 'fields', 'fields2')
+
+
+class AtlasSearchBackend:
+    name = 'atlas'
+    filter_fields = INDEX_FILTER_FIELDS
+
+    def search(self, spec, match_filter, date_range):
+        # Devuelve (etapa inicial, None): Atlas ordena por relevancia dentro de $search.
+        # La etapa es compartida entre peticiones iguales y no se debe modificar
+        filters = tuple(sorted((field, value) for field, value in match_filter.items() if field in self.filter_fields))
+        dates = (date_range.get('date_lo', {}).get('$gte'), date_range.get('date_hi', {}).get('$lte'))
+        return cached_search_stage(tuple(spec[key] for key in SPEC_KEYS), filters, dates), None
+
+    def invalidate(self):
+        # Atlas mantiene su índice al día con la propia colección
+        pass
+
+
+@lru_cache(maxsize=1024)
+def cached_search_stage(spec_values, filters, dates):
+    search_stage = build_search_stage(dict(zip(SPEC_KEYS, spec_values)))
+    # Los filtros (igualdad y rango de fechas) se aplican dentro del propio índice
+    clauses = [{"equals": {"path": field, "value": value}} for field, value in filters]
+    date_lo, date_hi = dates
+    if date_lo is not None:
+        clauses.append({"range": {"path": "date_lo", "gte": date_lo}})
+    if date_hi is not None:
+        clauses.append({"range": {"path": "date_hi", "lte": date_hi}})
+    return add_search_filters(search_stage, clauses) if clauses else search_stage
+
+
+def build_search_stage(spec):
+    fields = spec['fields'] or DEFAULT_FIELDS
+    fields2 = spec['fields2'] or DEFAULT_FIELDS
+    query_type, query = parse_query(spec['query'])
+    optional_query_type, optional_query = parse_query(spec['optional_query'])
+    search_type = spec['search_type']
+
+    if search_type in ('and', 'or') and optional_query:
+        stages = [
+            build_operator(query_type, query, fields),
+            build_operator(optional_query_type, optional_query, fields2)
+        ]
+        compound_type = "must" if search_type == 'and' else "should"
+        return {"$search": {"index": "default", "compound": {compound_type: stages}}}
+    elif search_type == 'mustnot' and optional_query:
+        return {
+            "$search": {
+                "index": "default",
+                "compound": {
+                    "must": [build_operator(query_type, query, fields)],
+                    "mustNot": [build_operator(optional_query_type, optional_query, fields2)]
+                }
+            }
+        }
+    else:
+        search_stage = {"$search": {"index": "default"}}
+        search_stage["$search"].update(build_operator(query_type, query, fields))
+        return search_stage
+
+
+_TOKEN = re.compile(r'\w+')
+# Separación de posiciones entre los valores de un array (autores, etc.) para que
+# una frase no pueda empezar en un valor y terminar en el siguiente
+_VALUE_GAP = 100
+# Como maxExpansions de Atlas: variantes fuzzy que se prueban por término
+_MAX_EXPANSIONS = 50
+_FUZZY_WEIGHT = 0.5
+
+
+def tokenize(text):
+    return _TOKEN.findall(fold_text(text))
+
+
+def _deletions(term):
+    # Vecindario de borrado: el término y todas las variantes con una letra menos.
+    # Dos términos a distancia de edición 1 comparten al menos una de estas claves
+    return {term} | {term[:i] + term[i + 1:] for i in range(len(term))}
+
+
+def _within_one_edit(a, b):
+    if a == b:
+        return True
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    if len(a) == len(b):
+        return a[i + 1:] == b[i + 1:]
+    return a[i:] == b[i + 1:]
+
+
+def _values(value):
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return [str(item) for item in value if item is not None]
+    return [str(value)]
+
+
+class InvertedIndex:
+    # Índice invertido en memoria: término -> documento -> campo -> posiciones
+
+    def __init__(self, fields, attributes):
+        self.fields = list(fields)
+        self.attributes = list(attributes)
+        self._postings = defaultdict(dict)
+        self._deletes = defaultdict(set)
+        self._doc_terms = {}
+        self._doc_attributes = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._doc_terms)
+
+    def add(self, doc):
+        # Añade o sustituye un documento (actualización incremental)
+        with self._lock:
+            doc_id = doc['_id']
+            if doc_id in self._doc_terms:
+                self.remove(doc_id)
+            terms = set()
+            for field in self.fields:
+                position = 0
+                for value in _values(doc.get(field)):
+                    for token in tokenize(value):
+                        self._postings[token].setdefault(doc_id, {}).setdefault(field, []).append(position)
+                        terms.add(token)
+                        position += 1
+                    position += _VALUE_GAP
+            for term in terms:
+                if len(self._postings[term]) == 1:
+                    for key in _deletions(term):
+                        self._deletes[key].add(term)
+            self._doc_terms[doc_id] = terms
+            self._doc_attributes[doc_id] = {name: doc.get(name) for name in self.attributes}
+
+    def remove(self, doc_id):
+        with self._lock:
+            for term in self._doc_terms.pop(doc_id, ()):
+                postings = self._postings[term]
+                postings.pop(doc_id, None)
+                if not postings:
+                    del self._postings[term]
+                    for key in _deletions(term):
+                        self._deletes[key].discard(term)
+                        if not self._deletes[key]:
+                            del self._deletes[key]
+            self._doc_attributes.pop(doc_id, None)
+
+    def _idf(self, term):
+        return math.log(1 + len(self._doc_terms) / len(self._postings[term]))
+
+    def _expand(self, token):
+        # Términos del índice a distancia de edición <= 1 (fuzzy maxEdits: 1)
+        candidates = set()
+        for key in _deletions(token):
+            candidates |= self._deletes.get(key, set())
+        variants = sorted((term for term in candidates if _within_one_edit(token, term)),
+                          key=lambda term: (term != token, -len(self._postings[term])))
+        return variants[:_MAX_EXPANSIONS]
+
+    def text(self, query, fields):
+        # Como el operador text: basta con que aparezca alguno de los términos
+        scores = defaultdict(float)
+        for token in tokenize(query):
+            for term in self._expand(token):
+                weight = self._idf(term) * (1.0 if term == token else _FUZZY_WEIGHT)
+                for doc_id, by_field in self._postings[term].items():
+                    for field in fields:
+                        positions = by_field.get(field)
+                        if positions:
+                            scores[doc_id] += weight * (1 + math.log(len(positions))) * SEARCH_BOOSTS.get(field, 1)
+        return scores
+
+    def phrase(self, query, fields):
+        # Como el operador phrase: los términos seguidos en el mismo campo
+        tokens = tokenize(query)
+        if not tokens or any(token not in self._postings for token in tokens):
+            return {}
+        weight = sum(self._idf(token) for token in tokens)
+        candidates = set(self._postings[tokens[0]])
+        for token in tokens[1:]:
+            candidates &= self._postings[token].keys()
+        scores = {}
+        for doc_id in candidates:
+            for field in fields:
+                first = self._postings[tokens[0]][doc_id].get(field)
+                if not first:
+                    continue
+                following = [set(self._postings[token][doc_id].get(field, ())) for token in tokens[1:]]
+                matches = sum(1 for start in first
+                              if all(start + offset in positions for offset, positions in enumerate(following, 1)))
+                if matches:
+                    scores[doc_id] = scores.get(doc_id, 0.0) + weight * (1 + math.log(matches)) * SEARCH_BOOSTS.get(field, 1)
+        return scores
+
+    def matches_filters(self, doc_id, match_filter, date_range):
+        attributes = self._doc_attributes[doc_id]
+        for field, expected in match_filter.items():
+            value = attributes.get(field)
+            if value != expected and not (isinstance(value, list) and expected in value):
+                return False
+        for field, condition in date_range.items():
+            value = attributes.get(field)
+            if value is None:
+                return False
+            if '$gte' in condition and value < condition['$gte']:
+                return False
+            if '$lte' in condition and value > condition['$lte']:
+                return False
+        return True
+
+
+class LocalSearchBackend:
+    # Búsqueda con el índice invertido en memoria. Se construye a partir de una
+    # copia de la colección la primera vez que se usa, y refresh() lo reconstruye
+    # entero cuando cambian los datos (ver invalidate).
+    name = 'local'
+    # Todos los filtros se aplican en memoria al buscar
+    filter_fields = ()
+
+    def __init__(self, load):
+        # load(projection) -> iterable de documentos de la colección
+        self._load = load
+        self._index = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    @property
+    def index(self):
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    self._index = self._build()
+        return self._index
+
+    def _build(self):
+        index = InvertedIndex(DEFAULT_FIELDS, ['source', 'type', 'publisher', 'city', 'date_lo', 'date_hi'])
+        projection = {field: 1 for field in index.fields + index.attributes}
+        for doc in self._load(projection):
+            index.add(doc)
+        return index
+
+    def refresh(self):
+        with self._refresh_lock:
+            index = self._build()
+            with self._lock:
+                self._index = index
+
+    def invalidate(self):
+        # La colección ha cambiado (ingest, backfill...): se reconstruye en segundo
+        # plano y mientras tanto se sigue buscando en el índice anterior. Si todavía
+        # no se ha construido, se construirá con los datos nuevos al usarlo. Los
+        # cambios se escriben desde otro proceso (flask ingest, backfill-fields) y
+        # solo llegan aquí como un cambio de generación, sin los documentos: por
+        # eso se reconstruye entero y no se actualiza registro a registro
+        if self._index is not None:
+            threading.Thread(target=self.refresh, name='search-index-refresh', daemon=True).start()
+
+    def search(self, spec, match_filter, date_range):
+        # Devuelve (etapa inicial, [(_id, puntuación)] de mayor a menor puntuación),
+        # ya filtrado por source/type/publisher/city y por fechas. Se puntúa y se
+        # filtra sobre el mismo índice: refresh() puede sustituirlo entretanto
+        index = self.index
+        with index._lock:
+            scores = self.score(spec, index)
+            ranked = [(doc_id, score) for doc_id, score in scores.items()
+                      if index.matches_filters(doc_id, match_filter, date_range)]
+        ranked.sort(key=lambda item: (-item[1], str(item[0])))
+        return {'$match': {'_id': {'$in': [doc_id for doc_id, _ in ranked]}}}, ranked
+
+    def score(self, spec, index=None):
+        # Un índice vacío es falso (__len__): se compara con None
+        index = self.index if index is None else index
+        fields = self._fields(spec['fields'])
+        fields2 = self._fields(spec['fields2'])
+        query_type, query = parse_query(spec['query'])
+        optional_query_type, optional_query = parse_query(spec['optional_query'])
+        search_type = spec['search_type']
+
+        with index._lock:
+            scores = getattr(index, query_type)(query, fields)
+            if not optional_query or search_type not in ('and', 'or', 'mustnot'):
+                return scores
+            optional_scores = getattr(index, optional_query_type)(optional_query, fields2)
+
+        if search_type == 'and':
+            return {doc_id: score + optional_scores[doc_id] for doc_id, score in scores.items() if doc_id in optional_scores}
+        if search_type == 'or':
+            combined = dict(scores)
+            for doc_id, score in optional_scores.items():
+                combined[doc_id] = combined.get(doc_id, 0.0) + score
+            return combined
+        return {doc_id: score for doc_id, score in scores.items() if doc_id not in optional_scores}
+
+    def _fields(self, fields):
+        if not fields:
+            return DEFAULT_FIELDS
+        return fields if isinstance(fields, list) else [fields]
+
+
+def make_search_backend(name, load):
+    if name == 'local':
+        return LocalSearchBackend(load)
+    return AtlasSearchBackend()
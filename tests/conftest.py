@@ -0,0 +1,64 @@
+import os
+import sys
+
+import pytest
+
+# Las pruebas no necesitan MongoDB ni Atlas: la colección es de mongomock y las
+# búsquedas de texto usan el índice local. El entorno se fija antes de importar app.
+os.environ['SEARCH_BACKEND'] = 'local'
+os.environ['SEARCH_CACHE_MAX_ENTRIES'] = '0'
+os.environ['LOG_LEVEL'] = 'WARNING'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+mongomock = pytest.importorskip('mongomock')
+
+import app as api  # noqa: E402
+import records  # noqa: E402
+
+# Sin arranque en caliente en segundo plano contra un MongoDB que no existe
+api.warm_up_started = True
+
+
+RECORDS = [
+    {'title': 'El llibre de les hores', 'authors': ['Joan Soler', 'Maria Puig'], 'source': 'A', 'type': 'book',
+     'year': 1920},
+    {'title': 'Història de Catalunya', 'authors': ['Maria Soler'], 'source': 'B', 'type': 'book',
+     'year': 1950, 'month': 3},
+    {'title': 'Cartes a un jove poeta', 'authors': ['Pere Vidal'], 'source': 'A', 'type': 'article',
+     'year': 1950, 'month': 3, 'day': 7},
+    {'title': 'Història del llibre', 'authors': ['Joan Pérez'], 'source': 'B', 'type': 'article'},
+]
+
+
+def make_records(count=40):
+    # Registros de prueba: los de RECORDS y otros con títulos y fechas repetidos,
+    # para que la ordenación tenga que desempatar por _id
+    docs = [dict(doc) for doc in RECORDS]
+    for i in range(count - len(docs)):
+        doc = {'title': f'Crònica {i % 7}', 'authors': [f'Autor {i % 5}'], 'source': 'A', 'type': 'misc'}
+        if i % 4:
+            doc['year'] = 1900 + i % 6
+        if i % 3 == 1:
+            doc['month'] = 1 + i % 12
+        docs.append(doc)
+    for doc in docs:
+        doc.update(records.derived_fields(doc))
+    return docs
+
+
+@pytest.fixture
+def collection(monkeypatch):
+    coll = mongomock.MongoClient().db['bilbiografia_1.0']
+    coll.insert_many(make_records())
+    monkeypatch.setattr(api, 'collection', coll)
+    monkeypatch.setattr(api, 'cache_state', coll.database['cache_state'])
+    monkeypatch.setattr(api, 'shared_vocabulary', None)
+    api.vocabulary_cache.invalidate()
+    api.autocomplete_cache.invalidate()
+    api.search_backend.refresh()
+    return coll
+
+
+@pytest.fixture
+def client(collection):
+    return api.app.test_client()
@@ -0,0 +1,14 @@
+import pytest
+
+
+@pytest.mark.parametrize('limit', ['0', '-3', '51', 'diez'])
+def test_rejects_limit_out_of_range(client, limit):
+    response = client.get('/autocomplete', query_string={'field': 'title', 'prefix': 'h', 'limit': limit})
+    assert response.status_code == 400
+    assert response.get_json()['message'] == 'Invalid parameter'
+
+
+def test_returns_at_most_limit_completions(client):
+    response = client.get('/autocomplete', query_string={'field': 'title', 'prefix': 'cr', 'limit': 2})
+    assert response.status_code == 200
+    assert len(response.get_json()) == 2
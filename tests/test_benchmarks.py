@@ -0,0 +1,17 @@
+import json
+
+import app as api
+from benchmarks import run
+
+
+def test_benchmark_suite_passes_on_mongomock(monkeypatch, tmp_path):
+    # El modo --mongomock documentado tiene que poder terminar sin escenarios fallidos
+    for name in ('client', 'db', 'collection', 'cache_state', 'shared_vocabulary'):
+        monkeypatch.setattr(api, name, getattr(api, name))
+    monkeypatch.setenv('MONGO_URI', 'mongodb://localhost:27017')
+    output, baseline = tmp_path / 'last_run.json', tmp_path / 'baseline.json'
+    status = run.main(['--mongomock', '--docs', '50', '--iterations', '1', '--warmup', '0',
+                       '--output', str(output), '--baseline', str(baseline), '--save-baseline'])
+    assert status == 0
+    scenarios = json.loads(output.read_text(encoding='utf-8'))['scenarios']
+    assert scenarios and not [name for name, stats in scenarios.items() if stats['failed']]
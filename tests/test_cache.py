@@ -0,0 +1,34 @@
+import threading
+
+from cache import LRUCache
+
+
+def make_cache():
+    return LRUCache(max_entries=10, max_bytes=1024, ttl=60, size_of=len)
+
+
+def test_caches_computed_values():
+    cache = make_cache()
+    assert cache.get_or_compute('a', lambda: 'uno') == 'uno'
+    assert cache.get_or_compute('a', lambda: 'dos') == 'uno'
+
+
+def test_value_computed_before_invalidate_is_not_stored():
+    cache = make_cache()
+    started, release = threading.Event(), threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return 'antiguo'
+
+    leader = threading.Thread(target=cache.get_or_compute, args=('a', slow))
+    leader.start()
+    assert started.wait(5)
+    cache.invalidate()
+    # Una petición posterior a la invalidación no espera al cálculo antiguo
+    assert cache.get_or_compute('a', lambda: 'nuevo') == 'nuevo'
+    release.set()
+    leader.join(5)
+    assert cache.get_or_compute('a', lambda: 'otro') == 'nuevo'
+    assert cache.stats()['entries'] == 1
@@ -0,0 +1,24 @@
+import json
+
+import pytest
+
+
+def exported_ids(client, **params):
+    response = client.get('/search/export', query_string={'format': 'ndjson', **params})
+    assert response.status_code == 200
+    return [json.loads(line)['_id'] for line in response.get_data(as_text=True).splitlines() if line]
+
+
+@pytest.mark.parametrize('params', [{'sortBy': 'date'}, {'query': 'crònica'}])
+def test_export_ignores_page(client, params):
+    everything = exported_ids(client, **params)
+    assert len(everything) == len(set(everything)) > 10
+    assert exported_ids(client, **params, page=3, limit=5) == everything
+
+
+@pytest.mark.parametrize('params', [{'sortBy': 'title'}, {'sortBy': 'date'}, {'query': 'crònica'}])
+def test_export_ignores_cursor(client, params):
+    everything = exported_ids(client, **params)
+    page = client.get('/search', query_string={**params, 'limit': 5}).get_json()
+    assert page['next_cursor']
+    assert exported_ids(client, **params, cursor=page['next_cursor']) == everything
@@ -0,0 +1,38 @@
+import pytest
+
+import app as api
+from ingest import ingest_file, read_bibtex
+
+BIBTEX = '''@string{bc = "Biblioteca de Catalunya"}
+@comment{Exportación de prueba}
+@book{a, title = {Primer}, source = bc}
+@preamble{"\\newcommand{\\noop}[1]{}"}
+@book{b, title = {Segon}, source = bc}
+@string{pr = "Proa"}
+@book{c, title = {Tercer}, source = bc, publisher = pr}
+@book{d, title = {Quart}, publisher = pr}
+'''
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 1000])
+def test_read_bibtex_keeps_string_macros_across_chunks(tmp_path, chunk_size):
+    path = tmp_path / 'registros.bib'
+    path.write_text(BIBTEX, encoding='utf-8')
+    records = list(read_bibtex(str(path), chunk_size=chunk_size))
+    assert [raw['title'] for raw in records] == ['Primer', 'Segon', 'Tercer', 'Quart']
+    assert [raw.get('source') for raw in records] == ['Biblioteca de Catalunya'] * 3 + [None]
+    assert [raw.get('publisher') for raw in records] == [None, None, 'Proa', 'Proa']
+
+
+def test_ingesting_an_export_after_backfill_adds_nothing(client, collection, tmp_path):
+    # backfill-fields calcula el content_hash de los registros que no venían de
+    # flask ingest, así que volver a cargar una exportación no los duplica
+    path = tmp_path / 'registros.ndjson'
+    path.write_bytes(client.get('/search/export', query_string={'format': 'ndjson'}).get_data())
+    result = api.app.test_cli_runner().invoke(args=['backfill-fields'])
+    assert result.exit_code == 0, result.output
+    count = collection.count_documents({})
+    stats = ingest_file(collection, str(path))
+    assert stats['inserted'] == 0
+    assert stats['existing'] == count
+    assert collection.count_documents({}) == count
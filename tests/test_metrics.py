@@ -0,0 +1,9 @@
+def test_invalid_sort_values_share_one_label(client):
+    for value in ('junk0', 'junk1'):
+        assert client.get('/search', query_string={'sortBy': value}).status_code == 400
+        assert client.get('/search/export', query_string={'sortBy': value}).status_code == 400
+    assert client.get('/search', query_string={'sortBy': 'Title'}).status_code == 200
+    body = client.get('/metrics').get_data(as_text=True)
+    assert 'junk' not in body
+    assert 'sort="invalid"' in body
+    assert 'sort="title"' in body
@@ -0,0 +1,140 @@
+import pytest
+
+import app as api
+from planner import build_keyset_match
+from search_backends import InvertedIndex, _deletions, _within_one_edit
+
+
+def search(client, **params):
+    response = client.get('/search', query_string=params)
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+
+def titles(body):
+    return sorted(doc['title'] for doc in body['results'])
+
+
+def test_within_one_edit():
+    assert _within_one_edit('llibre', 'llibre')
+    assert _within_one_edit('llibre', 'llibra')
+    assert _within_one_edit('llibre', 'libre')
+    assert _within_one_edit('llibre', 'llibres')
+    assert not _within_one_edit('llibre', 'llibrxx')
+    assert not _within_one_edit('llibre', 'lib')
+
+
+def test_deletions_share_a_key_within_one_edit():
+    assert _deletions('llibre') & _deletions('llibra')
+    assert not _deletions('llibre') & _deletions('cartes')
+
+
+def test_expand_finds_fuzzy_variants():
+    index = InvertedIndex(['title'], [])
+    index.add({'_id': 1, 'title': 'El llibre'})
+    index.add({'_id': 2, 'title': 'Els llibres'})
+    assert index._expand('llibre') == ['llibre', 'llibres']
+    assert index._expand('llibra') == ['llibre']
+    index.remove(1)
+    assert index._expand('llibra') == []
+
+
+def test_fuzzy_text_query(client):
+    assert titles(search(client, query='llibra')) == ['El llibre de les hores', 'Història del llibre']
+
+
+def test_phrase_query(client):
+    assert titles(search(client, query='"llibre de les"')) == ['El llibre de les hores']
+    assert search(client, query='"de llibre"')['total_documents'] == 0
+
+
+def test_phrase_does_not_cross_array_values(client):
+    # "Joan Soler" y "Maria Puig" son dos autores: "soler maria" no es una frase
+    assert titles(search(client, query='"joan soler"', fields='authors')) == ['El llibre de les hores']
+    assert search(client, query='"soler maria"', fields='authors')['total_documents'] == 0
+
+
+@pytest.mark.parametrize('search_type, expected', [
+    ('and', ['Història del llibre']),
+    ('or', ['Cartes a un jove poeta', 'El llibre de les hores', 'Història de Catalunya', 'Història del llibre']),
+    ('mustnot', ['Història de Catalunya']),
+])
+def test_compound_queries(client, search_type, expected):
+    body = search(client, query='història', optionalQuery='llibre poeta', searchTypeValue=search_type)
+    assert titles(body) == expected
+
+
+def test_build_keyset_match():
+    match = build_keyset_match([('sort_title', 1), ('_id', -1)], ['b', 5])
+    assert match == {'$match': {'$or': [
+        {'sort_title': {'$gt': 'b'}},
+        {'sort_title': 'b', '_id': {'$lt': 5}},
+    ]}}
+
+
+@pytest.mark.parametrize('sort_by', ['relevance', 'date', 'date-asc', 'title', 'title-desc'])
+@pytest.mark.parametrize('query', ['', 'crònica'])
+def test_cursor_walk_has_no_duplicates(client, collection, sort_by, query):
+    params = {'sortBy': sort_by, 'limit': 6, 'return_fields': 'title'}
+    if query:
+        params['query'] = query
+    first = search(client, **params)
+    seen = [doc['_id'] for doc in first['results']]
+    body = first
+    while body['next_cursor']:
+        # Un cursor que no avanza repetiría páginas para siempre
+        assert len(seen) < first['total_documents']
+        body = search(client, **params, cursor=body['next_cursor'])
+        seen.extend(doc['_id'] for doc in body['results'])
+    assert len(seen) == len(set(seen))
+    assert len(seen) == first['total_documents']
+    if not query:
+        assert len(seen) == collection.count_documents({})
+
+    # Los cursores dan las mismas páginas que la paginación por número de página
+    pages = []
+    for page in range(1, first['total_pages'] + 1):
+        pages.extend(doc['_id'] for doc in search(client, **params, page=page)['results'])
+    assert pages == seen
+
+
+def test_estimated_count_does_not_end_the_walk_early(client, collection, monkeypatch):
+    # Una estimación por debajo del total real (como lowerBound de Atlas) no
+    # puede cortar la paginación
+    monkeypatch.setattr(collection, 'estimated_document_count', lambda: 3)
+    params = {'sortBy': 'date', 'limit': 6, 'count': 'estimate'}
+    body = search(client, **params)
+    assert body['total_is_estimate']
+    assert body['total_documents'] == 7
+    seen = [doc['_id'] for doc in body['results']]
+    while body['next_cursor']:
+        assert len(seen) < collection.count_documents({})
+        body = search(client, **params, cursor=body['next_cursor'])
+        seen.extend(doc['_id'] for doc in body['results'])
+    assert len(set(seen)) == collection.count_documents({})
+
+
+def test_refresh_between_scoring_and_filtering(client, collection, monkeypatch):
+    # refresh() en segundo plano puede sustituir el índice a mitad de búsqueda:
+    # los documentos puntuados tienen que filtrarse en el mismo índice
+    backend = api.search_backend
+    score = backend.score
+
+    def score_then_refresh(spec, *index):
+        scores = score(spec, *index)
+        collection.delete_one({'title': 'El llibre de les hores'})
+        backend.refresh()
+        return scores
+
+    monkeypatch.setattr(backend, 'score', score_then_refresh)
+    assert titles(search(client, query='llibre', source='B')) == ['Història del llibre']
+
+
+def test_batch_accepts_facet_lists(client):
+    queries = [{'facets': ['source', 'type'], 'limit': 1}, {'facets': 'source,type', 'limit': 1}]
+    response = client.post('/search/batch', json=queries)
+    assert response.status_code == 200
+    first, second = response.get_json()['results']
+    assert first['status'] == second['status'] == 200
+    assert first['body']['facets'] == second['body']['facets']
+    assert set(first['body']['facets']) == {'source', 'type'}
@@ -0,0 +1,16 @@
+import app as api
+
+
+def test_facets_are_sorted_by_count_then_value(client):
+    response = client.get('/facets')
+    assert response.status_code == 200
+    for buckets in response.get_json().values():
+        keys = [(-bucket['count'], bucket['value']) for bucket in buckets]
+        assert keys == sorted(keys)
+
+
+def test_facets_etag_survives_recompute(client):
+    etag = client.get('/facets').headers['ETag']
+    api.vocabulary_cache.invalidate()
+    response = client.get('/facets', headers={'If-None-Match': etag})
+    assert response.status_code == 304
@@ -0,0 +1,28 @@
+from types import SimpleNamespace
+
+import pytest
+
+import app as api
+
+
+@pytest.fixture
+def warm_up(client, monkeypatch):
+    # mongomock no implementa el comando ping
+    monkeypatch.setattr(api, 'client', SimpleNamespace(admin=SimpleNamespace(command=lambda name: {'ok': 1})))
+    api.ready.clear()
+    yield api.warm_up
+    api.ready.clear()
+
+
+def test_ready_after_warm_up(warm_up, client):
+    warm_up()
+    assert api.ready.is_set()
+    assert client.get('/healthz').status_code == 200
+
+
+def test_failing_search_is_not_ready(warm_up, client, monkeypatch):
+    monkeypatch.setattr(api, 'run_search', lambda args: ({"message": "Error during search"}, 500))
+    with pytest.raises(RuntimeError):
+        warm_up()
+    assert not api.ready.is_set()
+    assert client.get('/healthz').status_code == 503